@@ -13,76 +13,356 @@ import operator # operator.attrgetter, operator.itemgetter
 import struct
 import array
 import StringIO
+import time
+import math
+import uuid
+import datetime
 
 from google.appengine.ext import db # import database
 from google.appengine.api import memcache, users # import memory cache and user
 
 import common
+import metrics
+import preprocessing
 
-def search(spectrum_data):
+_matchers = {}
+'''Up-to-date Matchers kept between requests on this instance, with the
+generation each was loaded at, by spectrum type
+@type: C{dict}'''
+
+RESULT_SET_SIZE = 100
+'''Number of best results ranked and kept for paging when searching with a
+cursor, unless a page is bigger than this
+@type: C{int}'''
+
+RESULT_SET_TIME = 600
+'''Number of seconds ranked results are kept for paging
+@type: C{int}'''
+
+DTW_PAIRWISE_LIMIT = 10
+'''Number of spectra that can be compared to each other at once with
+dynamic time warping, since every pair of them is warped
+@type: C{int}'''
+
+def search(spectrum_data, spectrum_type=None, algorithm="bove", k=None, stage=None):
     '''
     Search for a spectrum based on a given file descriptor.
     
-    object to find candidates for similar spectra in the database and compare
     Parse the given file and create a Spectrum object for it. Use the Matcher
+    object to find candidates for similar spectra in the database and compare
     all candidates to the original spectrum using linear comparison algorithms.
     
+    Each spectrum type has its own Matcher. By default only the one for the
+    type given in the file header is searched, but the search can be forced
+    onto another type or fanned out to all of them.
+    
     @param spectrum_data: String containing spectrum information
     @type  spectrum_data: C{str}
+    @param spectrum_type: Type of spectra to search, "all" for every type,
+    or None for the type of the given spectrum
+    @type  spectrum_type: C{str}
+    @param algorithm: Name of the metric to compare spectra with
+    @type  algorithm: C{str}
+    @param k: Number of best candidates to return, or None for all of them
+    @type  k: C{int}
+    @param stage: Preprocessing stage to compare the data after, or None to
+    compare the raw integrated data
+    @type  stage: C{str}
     @return: List of candidates similar to the input spectrum
     @rtype: C{list} of L{backend.Spectrum}
-    @raise common.InputError: If a non-string is given as spectrum_data
+    @raise common.InputError: If a non-string is given as spectrum_data, or
+    an invalid spectrum type, algorithm or preprocessing stage is given
     '''
-    if not isinstance(spectrum_data, str) or isinstance(spectrum_data, unicode):
-        raise common.InputError(spectrum_data, "Invalid spectrum data.")
-    # Load the user's spectrum into a Spectrum object.
-    spectrum = Spectrum()
-    spectrum.parse_string(spectrum_data)
-    # Check cache for the Matcher. If not, get from database.
-    matcher = memcache.get(spectrum.spectrum_type+'_matcher')
-    if matcher is None:
-        matcher = Matcher.get_by_key_name(spectrum.spectrum_type+'_matcher')
-    matcher = Matcher.all().get() #Debugging
-    # Get the candidates for similar spectra.
-    candidates = matcher.get(spectrum)
-    # Do one-to-one on candidates and sort by error
-    for candidate in candidates:
-        candidate.error = Matcher.bove(spectrum, candidate)
-    candidates.sort(key=operator.attrgetter('error'))
+    results = search_many([spectrum_data], spectrum_type, algorithm, k, stage)[0]
+    for candidate, error in results:
+        candidate.error = error
     # Let frontend do the rest
-    return candidates
+    return [candidate for candidate, error in results]
 
-def compare(dataList, algorithm="bove"):
+def search_many(spectra_data, spectrum_type=None, algorithm="bove", k=None, stage=None):
+    '''
+    Search for several spectra at once.
+    
+    Every query gets the same candidates it would get from L{search}, but
+    each Matcher is loaded once, the candidates of all the queries are
+    fetched together in one batch, and each candidate is only prepared for
+    scoring once however many queries it is a candidate for.
+    
+    @param spectra_data: Strings containing spectrum information
+    @type  spectra_data: C{list} of C{str}
+    @param spectrum_type: Type of spectra to search, "all" for every type,
+    or None for the type of each given spectrum
+    @type  spectrum_type: C{str}
+    @param algorithm: Name of the metric to compare spectra with
+    @type  algorithm: C{str}
+    @param k: Number of best candidates to return per query, or None for all
+    of them
+    @type  k: C{int}
+    @param stage: Preprocessing stage to compare the data after, or None to
+    compare the raw integrated data
+    @type  stage: C{str}
+    @return: For each query, its candidates and their errors, best first
+    @rtype: C{list} of C{list} of C{tuple}
+    @raise common.InputError: If a non-string is given in spectra_data, or
+    an invalid spectrum type, algorithm or preprocessing stage is given
+    '''
+    spectra = []
+    for spectrum_data in spectra_data:
+        if not isinstance(spectrum_data, basestring):
+            raise common.InputError(spectrum_data, "Invalid spectrum data.")
+        # Load the user's spectrum into a Spectrum object.
+        spectrum = Spectrum()
+        spectrum.parse_string(spectrum_data)
+        spectra.append(spectrum)
+    common.lap("parse")
+    # Load each Matcher searched once.
+    matchers = {}
+    for spectrum in spectra:
+        for partition in _partitions(spectrum_type or spectrum.spectrum_type):
+            if partition not in matchers:
+                matchers[partition] = get_matcher(partition)
+    common.lap("matcher")
+    # Get the candidates for similar spectra from each Matcher searched, and
+    # give each distinct candidate one place in the shared list.
+    keys = []
+    positions = {}
+    indexes = []
+    for spectrum in spectra:
+        query = []
+        for partition in _partitions(spectrum_type or spectrum.spectrum_type):
+            for key in matchers[partition].candidates(spectrum):
+                if key not in positions:
+                    positions[key] = len(keys)
+                    keys.append(key)
+                query.append(positions[key])
+        indexes.append(query)
+    common.lap("candidates")
+    # Fetch them all together, skipping spectra deleted since the Matchers
+    # were loaded.
+    candidates = Spectrum.get(keys)
+    positions = {}
+    for index, candidate in enumerate(candidates):
+        if candidate is not None:
+            positions[index] = len(positions)
+    indexes = [[positions[index] for index in query if index in positions]
+               for query in indexes]
+    candidates = [candidate for candidate in candidates if candidate is not None]
+    if stage is not None:
+        load_stages(candidates)
+    common.lap("fetch")
+    matrix = [candidate.preprocessed(stage) for candidate in candidates]
+    cascade = (k is not None and stage is None and
+               algorithm in ("bove", "leastsquares", "euclidean"))
+    if cascade:
+        # Only the best few are wanted, so rank at the stored coarse
+        # resolutions first and give up on hopeless ones early.
+        levels = [(bins, [candidate.downsampled(bins) for candidate in candidates])
+                  for bins in Spectrum.RESOLUTIONS]
+    results = []
+    for spectrum, query in zip(spectra, indexes):
+        rows = [matrix[index] for index in query]
+        if cascade:
+            best = metrics.cascade(algorithm, spectrum.data, rows, k,
+                                   [(spectrum.downsampled(bins),
+                                     [coarse[index] for index in query])
+                                    for bins, coarse in levels])
+        elif k is not None:
+            best = metrics.top_k(algorithm, spectrum.preprocessed(stage), rows, k)
+        else:
+            # Do one-to-one on candidates and sort by error
+            errors = metrics.score(algorithm, spectrum.preprocessed(stage), rows)
+            best = sorted(zip(errors, range(len(rows))), key=operator.itemgetter(0))
+        results.append([(candidates[query[index]], error) for error, index in best])
+    common.lap("score")
+    return results
+
+def search_page(spectra_data=None, spectrum_type=None, algorithm="bove", k=10,
+                stage=None, cursor=None):
+    '''
+    Search for spectra one page of results at a time.
+    
+    Without a cursor, search for the given spectra, rank their best
+    L{RESULT_SET_SIZE} results, return the first k and keep the keys and
+    errors of the rest for a short while. With a cursor, return the next k
+    of those kept results, fetching only the spectra on that page.
+    
+    @param spectra_data: Strings containing spectrum information, when not
+    given a cursor
+    @type  spectra_data: C{list} of C{str}
+    @param spectrum_type: Type of spectra to search, "all" for every type,
+    or None for the type of each given spectrum
+    @type  spectrum_type: C{str}
+    @param algorithm: Name of the metric to compare spectra with
+    @type  algorithm: C{str}
+    @param k: Number of results per page
+    @type  k: C{int}
+    @param stage: Preprocessing stage to compare the data after, or None to
+    compare the raw integrated data
+    @type  stage: C{str}
+    @param cursor: Cursor returned with the previous page, or None to start
+    a new search
+    @type  cursor: C{str}
+    @return: For each query, the page of its candidates and their errors,
+    and the cursor of the next page, or None if this is the last page
+    @rtype: C{tuple} of C{list} and C{str}
+    @raise common.InputError: If k is not positive, the cursor is invalid or
+    has expired, or L{search_many} rejects the search
+    '''
+    if k < 1:
+        raise common.InputError(k, "Invalid number of results.")
+    if cursor is None:
+        results = search_many(spectra_data, spectrum_type, algorithm,
+                              max(k, RESULT_SET_SIZE), stage)
+        ranked = [[(str(candidate.key()), error) for candidate, error in result]
+                  for result in results]
+        pages = [result[:k] for result in results]
+        offset = 0
+        result_set = None
+    else:
+        try:
+            result_set, offset = cursor.split(":")
+            offset = int(offset)
+        except ValueError:
+            raise common.InputError(cursor, "Invalid cursor.")
+        ranked = memcache.get("results_" + result_set)
+        if ranked is None:
+            raise common.InputError(cursor, "Invalid or expired cursor.")
+        # Fetch every query's page together.
+        keys = [[key for key, error in result[offset:offset + k]] for result in ranked]
+        spectra = iter(Spectrum.get(sum(keys, [])))
+        pages = []
+        for result in ranked:
+            page = []
+            for key, error in result[offset:offset + k]:
+                spectrum = spectra.next()
+                if spectrum is not None:
+                    # Skip spectra deleted since the search.
+                    page.append((spectrum, error))
+            pages.append(page)
+    offset += k
+    if not [result for result in ranked if len(result) > offset]:
+        return pages, None
+    if result_set is None:
+        # Keep the ranking for the following pages.
+        result_set = uuid.uuid4().hex
+        memcache.set("results_" + result_set, ranked, RESULT_SET_TIME)
+    return pages, "%s:%d" % (result_set, offset)
+
+def compare(dataList, algorithm="bove", mode="first", stage=None):
     '''
     Compare multiple spectra using the given algorithm.
     
-    @param dataList: A list of spectra strings to compare
+    By default every spectrum is compared to the first one. The other modes
+    compare every spectrum to every other one and return either the whole
+    distance matrix, each spectrum's nearest neighbour, or an average-linkage
+    clustering of the spectra (see L{metrics.linkage}).
+    
+    @param dataList: A list of spectra strings, or database keys prefixed
+    with "db:", to compare
     @type  dataList: [C{str}]
-    @return: Calculated error between the two spectra
-    @rtype: C{int}
-    @raise common.InputError: If a non-string is given as spectrum_data or if
-    an invalid algorithm is given.
+    @param algorithm: Name of the metric to compare spectra with
+    @type  algorithm: C{str}
+    @param mode: "first", "matrix", "nearest" or "cluster"
+    @type  mode: C{str}
+    @param stage: Preprocessing stage to compare the data after, or None to
+    compare the raw integrated data
+    @type  stage: C{str}
+    @return: The spectra, with the error to the first one set on each, for
+    the "first" mode, and the spectra and the pairwise result otherwise
+    @rtype: C{list} of L{backend.Spectrum}, or C{tuple}
+    @raise common.InputError: If a non-string is given as spectrum_data, an
+    invalid database key is given, an invalid algorithm, mode or
+    preprocessing stage is given, or more than L{DTW_PAIRWISE_LIMIT} spectra
+    are compared to each other with dynamic time warping.
     '''
+    if mode not in ("first", "matrix", "nearest", "cluster"):
+        raise common.InputError(mode, "Invalid comparison mode.")
+    if algorithm == "dtw" and mode != "first" and len(dataList) > DTW_PAIRWISE_LIMIT:
+        raise common.InputError(len(dataList), "Too many spectra to compare pairwise "
+                                "with dynamic time warping.")
     # First check for invalid spectrum data (if they are not strings).
     spectra = []
+    references = []
     for data in dataList:
-        if not isinstance(data1, str) or isinstance(spectrum_data, unicode):
+        if not isinstance(data, basestring):
             raise common.InputError(data, "Invalid spectrum data.")
         if data[0:3] == "db:":
-            spectrum1 = Spectrum.get(data[3:])
+            # Fetch all referenced spectra together below.
+            references.append((len(spectra), data[3:]))
+            spectra.append(None)
         else:
             spectrum = Spectrum()
             spectrum.parse_string(data)
             spectra.append(spectrum)
+    if references:
+        try:
+            stored = Spectrum.get([key for index, key in references])
+        except db.BadKeyError:
+            stored = [None]
+        if None in stored:
+            raise common.InputError([key for index, key in references],
+                                    "Invalid spectrum key.")
+        for (index, key), spectrum in zip(references, stored):
+            spectra[index] = spectrum
+    if not spectra:
+        if mode == "first":
+            return spectra
+        return spectra, []
+    if stage is not None:
+        load_stages(spectra)
+    matrix = [spectrum.preprocessed(stage) for spectrum in spectra]
     # Start comparing
-    for spectrum in spectra:
-        if algorithm == "bove":
-            spectrum.error = Matcher.bove(spectra[0], spectrum)
-        elif algorithm == "leastsquares":
-            spectrum.error = Matcher.leastsquares(spectra[0], spectrum)
-        else:
-            raise common.InputError(algo, "Invalid algorithm selection.")
-    return spectra
+    if mode == "first":
+        errors = metrics.score(algorithm, matrix[0], matrix)
+        for spectrum, error in zip(spectra, errors):
+            spectrum.error = error
+        return spectra
+    distances = metrics.pairwise(algorithm, matrix)
+    if mode == "nearest":
+        return spectra, metrics.nearest(distances)
+    elif mode == "cluster":
+        return spectra, metrics.linkage(distances)
+    return spectra, distances
+
+def mixture(spectrum_data, spectrum_type=None, limit=300):
+    '''
+    Break a spectrum of a mixture down into spectra from the database.
+    
+    Take the best candidates the Matcher finds for the spectrum, then find the
+    non-negative weights of those candidates that best add up to it.
+    
+    @param spectrum_data: String containing spectrum information
+    @type  spectrum_data: C{str}
+    @param spectrum_type: Type of spectra to search, "all" for every type,
+    or None for the type of the given spectrum
+    @type  spectrum_type: C{str}
+    @param limit: Maximum number of candidates to mix
+    @type  limit: C{int}
+    @return: Spectra in the mixture with their weights set, largest weight
+    first, and the norm of what is left unexplained
+    @rtype: C{tuple} of C{list} of L{backend.Spectrum} and C{float}
+    @raise common.InputError: If a non-string is given as spectrum_data or
+    an invalid spectrum type is given
+    '''
+    if not isinstance(spectrum_data, basestring):
+        raise common.InputError(spectrum_data, "Invalid spectrum data.")
+    spectrum = Spectrum()
+    spectrum.parse_string(spectrum_data)
+    keys = []
+    for partition in _partitions(spectrum_type or spectrum.spectrum_type):
+        keys.extend(get_matcher(partition).candidates(spectrum))
+    candidates = Spectrum.get(keys[:limit])
+    if not candidates:
+        return [], math.sqrt(sum([value * value for value in spectrum.data]))
+    weights, residual = metrics.nnls([candidate.data for candidate in candidates],
+                                     spectrum.data)
+    components = []
+    for candidate, weight in zip(candidates, weights):
+        if weight > 0:
+            candidate.weight = weight
+            components.append(candidate)
+    components.sort(key=operator.attrgetter('weight'), reverse=True)
+    return components, residual
 
 def browse(target="public", limit=10, offset=0, guess="", type=""):
     '''
@@ -94,6 +374,10 @@ def browse(target="public", limit=10, offset=0, guess="", type=""):
     @type  limit: C{int}
     @param offset: Where to start listing from (for pagination)
     @type  offset: C{int}
+    @param guess: What the user has typed, when getting search suggestions
+    @type  guess: C{str}
+    @param type: Type of spectra to suggest, or "" for all of them
+    @type  type: C{str}
     @return: List of spectra
     @rtype: C{list} of L{backend.Spectrum}
     @raise common.InputError: If the user tries to retrieve too many spectra
@@ -103,13 +387,16 @@ def browse(target="public", limit=10, offset=0, guess="", type=""):
     if limit > 50:
         raise common.InputError(limit, "Number of spectra to retrieve is too big.")
     if guess:
-        # Check cache for the Matcher. If not, get from database.
-        matcher = memcache.get(type + '_matcher')
-        if matcher is None:
-            matcher = Matcher.get_by_key_name(type)
-        return matcher.browse(guess)
+        # Get suggestions from the Matcher for each type asked for.
+        keys = []
+        for partition in _partitions(type or "all"):
+            keys.extend(get_matcher(partition).suggest(guess, limit - len(keys)))
+            if len(keys) >= limit:
+                break
+        return Spectrum.get(keys)
     else:
-        target = Project.get_or_insert(target)
+        if target == "public":
+            target = Project.get_or_insert(target)
         return Spectrum.get(target.spectra[offset:offset + limit])
 
 def add(spectrum_data, target="public", preprocessed=False):
@@ -123,12 +410,15 @@ def add(spectrum_data, target="public", preprocessed=False):
     @param spectrum_data: String containing spectrum information
     @type  spectrum_data: C{str}
     @param target: Where to store the spectrum
-    @type  target: "public" or a db key
+    @type  target: "public" or L{backend.Project}
     @param preprocessed: Whether spectrum_data is already integrated or not
     @type  preprocessed: C{bool}
     '''
-    # If project does not exist, make a new one.
-    project = Project.get_or_insert(target)
+    if target == "public":
+        # If the public project does not exist, make a new one.
+        project = Project.get_or_insert(target)
+    else:
+        project = target
     # Load the user's spectrum into a Spectrum object.
     if not preprocessed:
         spectrum = Spectrum()
@@ -137,21 +427,135 @@ def add(spectrum_data, target="public", preprocessed=False):
         import urllib
         data = eval(urllib.unquote(spectrum_data))
         spectrum = Spectrum(**data)
-    spectrum.put()
-    project.spectra.append(spectrum.key())
-    project.put()
+    put_spectra([spectrum])
+    extend_project(project, [spectrum.key()])
     if target == "public":
-        # Check cache for the Matcher. If not, get from database. If it's
-        # not there, make a new one.
-        matcher = memcache.get(spectrum.spectrum_type + '_matcher')
-        if matcher is None:
-            matcher = Matcher.get_by_key_name(spectrum.spectrum_type)
-        if not matcher:
-            matcher = Matcher(key_name=spectrum.spectrum_type)
-        matcher.add(spectrum)
-        # Update the Matcher to the database and the cache.
-        matcher.put()
-        memcache.set(spectrum.spectrum_type + '_matcher', matcher)
+        # Log the change instead of rewriting the whole Matcher.
+        MatcherDelta.log_add(spectrum)
+        bump_generation(spectrum.spectrum_type)
+        compact(spectrum.spectrum_type)
+
+def add_many(spectra_data, target="public", preprocessed=False, key_names=None, fold=True):
+    '''
+    Add a batch of new spectra to the database at once.
+    
+    Parse all the given files, store the spectra and update the project with
+    one batched write each, then merge them all into the Matcher in a single
+    compaction rather than one at a time.
+    
+    Given key names, adding the same batch again stores nothing twice, so a
+    batch that failed part way can simply be added again.
+    
+    @param spectra_data: Strings containing spectrum information
+    @type  spectra_data: C{list} of C{str}
+    @param target: Where to store the spectra
+    @type  target: "public" or L{backend.Project}
+    @param preprocessed: Whether spectra_data is already integrated or not
+    @type  preprocessed: C{bool}
+    @param key_names: Key names to store the spectra under, or None to let
+    the database pick keys
+    @type  key_names: C{list} of C{str}
+    @param fold: Whether to fold the changes into the Matchers now, or only
+    log them for the caller to compact once after several batches
+    @type  fold: C{bool}
+    '''
+    if target == "public":
+        # If the public project does not exist, make a new one.
+        project = Project.get_or_insert(target)
+    else:
+        project = target
+    if key_names is None:
+        key_names = [None] * len(spectra_data)
+    # Load the user's spectra into Spectrum objects.
+    spectra = []
+    for spectrum_data, key_name in zip(spectra_data, key_names):
+        if not preprocessed:
+            spectrum = Spectrum(key_name=key_name)
+            spectrum.parse_string(spectrum_data)
+        else:
+            import urllib
+            data = eval(urllib.unquote(spectrum_data))
+            spectrum = Spectrum(key_name=key_name, **data)
+        spectra.append(spectrum)
+    put_spectra(spectra)
+    extend_project(project, [spectrum.key() for spectrum in spectra])
+    if target == "public":
+        index_many(spectra, fold)
+
+def index_many(spectra, fold=True):
+    '''
+    Merge a batch of stored public spectra into the Matchers for their types.
+    
+    Log all the changes in one write, then fold them in together. Spectra the
+    Matchers already have are left as they are.
+    
+    @param spectra: The spectra to merge
+    @type  spectra: C{list} of L{backend.Spectrum}
+    @param fold: Whether to fold the changes into the Matchers now, or leave
+    them in the log for a later compaction
+    @type  fold: C{bool}
+    '''
+    MatcherDelta.log_add_many(spectra)
+    for spectrum_type in set([spectrum.spectrum_type for spectrum in spectra]):
+        bump_generation(spectrum_type)
+        if fold:
+            compact(spectrum_type, True)
+
+def put_spectra(spectra):
+    '''
+    Store spectra, with their preprocessed data worked out for every stage.
+    
+    @param spectra: The spectra to store
+    @type  spectra: C{list} of L{backend.Spectrum}
+    '''
+    db.put(spectra)
+    db.put([SpectrumStages(parent=spectrum, key_name='stages',
+                           **dict([(stage + '_data', spectrum.preprocessed(stage))
+                                   for stage in preprocessing.STAGES]))
+            for spectrum in spectra])
+
+def extend_project(project, keys):
+    '''
+    Add spectra to a project, leaving out any it already has.
+    
+    The project is read again and written in a transaction, so batches
+    added to it at the same time do not drop each other's spectra.
+    
+    @param project: The project
+    @type  project: L{backend.Project}
+    @param keys: Keys of the spectra to add
+    @type  keys: C{list} of L{google.appengine.ext.db.Key}
+    @return: The project as written
+    @rtype: L{backend.Project}
+    '''
+    def extend():
+        extended = Project.get(project.key())
+        stored = set(extended.spectra)
+        extended.spectra.extend([key for key in keys if key not in stored])
+        extended.put()
+        return extended
+    return db.run_in_transaction(extend)
+
+def load_stages(spectra):
+    '''
+    Fetch the stored preprocessed data of a batch of spectra at once.
+    
+    Spectra that were not stored, or were stored before their preprocessed
+    data was kept, work it out when asked instead.
+    
+    @param spectra: The spectra
+    @type  spectra: C{list} of L{backend.Spectrum}
+    '''
+    stored = [spectrum for spectrum in spectra if spectrum.is_saved()]
+    for spectrum, stages in zip(stored, SpectrumStages.get([spectrum.stages_key()
+                                                          for spectrum in stored])):
+        if stages is None:
+            continue
+        spectrum.stages = {}
+        for stage in preprocessing.STAGES:
+            data = getattr(stages, stage + '_data')
+            if data:
+                spectrum.stages[stage] = data
 
 def delete(spectrum_data, target="public"):
     '''
@@ -168,47 +572,472 @@ def delete(spectrum_data, target="public"):
     spectrum = Spectrum.get(spectrum_data)
     # Remove it from the Matcher if in a public database.
     if target == "public":
-        # Check cache for the Matcher. If not, get from database. If it's
-        # not there, make a new one.
-        matcher = memcache.get(spectrum.spectrum_type + '_matcher')
-        if matcher is None:
-            matcher = Matcher.get_by_key_name(spectrum.spectrum_type)
-        if not matcher:
-            matcher = Matcher(key_name=spectrum.spectrum_type)
-        matcher.delete(spectrum)
-        # Update the Matcher to the database and the cache.
-        matcher.put()
-        memcache.set(spectrum.spectrum_type + '_matcher', matcher)
+        project = Project.get_or_insert(target)
+        # Log the change instead of rewriting the whole Matcher.
+        MatcherDelta.log_delete(spectrum)
+        bump_generation(spectrum.spectrum_type)
+        compact(spectrum.spectrum_type)
     else:
         # If private, check if it is indeed the user's database.
-        if not spectrum.project == target:
-            raise common.AuthError(target, "Spectrum does not belong to targeted project.")
-    # Delete the spectrum from the database.
-    [matcher.spectrum.remove(spectrum.key())
-      for matcher in Matcher.gql("WHERE :1 in spectra", spectrum.key())]
-    spectrum.delete()
+        project = target
+        if spectrum.key() not in project.spectra:
+            raise common.AuthError(users.get_current_user(),
+                                   "Spectrum does not belong to targeted project.")
+    # Delete the spectrum from the project and the database.
+    if spectrum.key() in project.spectra:
+        project.spectra.remove(spectrum.key())
+        project.put()
+    db.delete([spectrum.key(), spectrum.stages_key()])
 
 def update():
     '''
-    Purge the Matcher class and trigger a complete regeneration of heuristic
-    data. This should only be used when fixing a corrupt database.
+    Rebuild every Matcher from the spectra in the database. This should only
+    be used when fixing a corrupt database.
+    
+    The new Matchers are built beside the ones in use, which keep answering
+    searches until readers are switched over to the new ones. This runs in
+    one request, so for a real library start it as a background job with
+    L{jobs.start_update} instead, which builds them a chunk at a time.
     '''
-    # Delete all matcher classes then re-add everything
-    [db.delete(matcher) for matcher in Matcher.all()]
-    # Clear all spectra from the project.
-    project = Project.get_by_key_name("public")
-    project.spectra = []
-    # Regenerate heuristics data.
-    matchers = {}
+    name = uuid.uuid4().hex
+    start_rebuild(name)
+    project = Project.get_or_insert("public")
+    stored = set(project.spectra)
+    # Regenerate heuristics data, merging spectra in batches.
+    matchers = dict((spectrum_type, get_rebuild_matcher(spectrum_type, name))
+                    for spectrum_type in Spectrum.spectrum_type.choices)
+    batches = dict((spectrum_type, []) for spectrum_type in matchers)
     for spectrum in Spectrum.all():
-        if not matchers.get(spectrum.spectrum_type):
-            matchers[spectrum.spectrum_type] = Matcher.get_or_insert(spectrum.spectrum_type)
-        matchers[spectrum.spectrum_type].add(spectrum)
-        project.spectra.append(spectrum.key())
-    # Put Matchers and project back in database.
+        batch = batches[spectrum.spectrum_type]
+        batch.append(spectrum)
+        if len(batch) >= Matcher.BATCH_SIZE:
+            matchers[spectrum.spectrum_type].add_many(batch)
+            del batch[:]
+        if spectrum.key() not in stored:
+            project.spectra.append(spectrum.key())
+    for spectrum_type, batch in batches.iteritems():
+        matchers[spectrum_type].add_many(batch)
+        matchers[spectrum_type].put()
     project.put()
-    [matcher.put() for matcher in matchers.itervalues()]
-    [memcache.set(key + '_matcher', value) for key, value in matchers.iteritems()]
+    for spectrum_type in matchers:
+        finish_rebuild(spectrum_type, name)
+
+def start_rebuild(name):
+    '''
+    Start building a new generation of Matchers beside the ones in use.
+    
+    From now on, compaction keeps the changes it folds in, so that
+    L{finish_rebuild} can replay them onto the new Matchers. That starts a
+    little before now, since a request that logged a change just before may
+    still be making it.
+    
+    @param name: Name of the new generation
+    @type  name: C{str}
+    @raise common.ServerError: If a Matcher is being compacted, so the
+    rebuild should be started again later
+    '''
+    since = datetime.datetime.now() - datetime.timedelta(seconds=MatcherHead.REPLAY_MARGIN)
+    for spectrum_type in Spectrum.spectrum_type.choices:
+        # Keep compaction from deleting changes while the head is changed.
+        if not memcache.add(spectrum_type + '_compacting', True, time=60):
+            raise common.ServerError("Matcher is being compacted.")
+        try:
+            head = MatcherHead.get_or_insert(spectrum_type, matcher=spectrum_type)
+            if head.matcher == "%s:%s" % (spectrum_type, name):
+                # A rebuild started again after failing part way through
+                # switching has nothing left to build for this type.
+                continue
+            head.building = "%s:%s" % (spectrum_type, name)
+            head.since = since
+            head.put()
+        finally:
+            memcache.delete(spectrum_type + '_compacting')
+
+def cancel_rebuild(spectrum_type, name):
+    '''
+    Give up on a Matcher being built by a rebuild, so compaction stops
+    keeping changes for it, then delete it.
+    
+    @param spectrum_type: Type of spectrum the Matcher is for
+    @type  spectrum_type: C{str}
+    @param name: Name of the generation given up on
+    @type  name: C{str}
+    @raise common.ServerError: If the Matcher is being compacted, so it
+    should be given up on later
+    '''
+    key_name = "%s:%s" % (spectrum_type, name)
+    if not memcache.add(spectrum_type + '_compacting', True, time=60):
+        raise common.ServerError("Matcher is being compacted.")
+    try:
+        head = MatcherHead.get_by_key_name(spectrum_type)
+        if head is None or head.building != key_name:
+            # Already switched over, or a newer rebuild has started.
+            return
+        head.building = None
+        head.since = None
+        head.put()
+    finally:
+        memcache.delete(spectrum_type + '_compacting')
+    db.delete(db.Key.from_path('Matcher', key_name))
+
+def get_rebuild_matcher(spectrum_type, name):
+    '''
+    Get a Matcher being built by a rebuild, or a new one if nothing has been
+    stored in it yet.
+    
+    @param spectrum_type: Type of spectrum the Matcher is for
+    @type  spectrum_type: C{str}
+    @param name: Name of the new generation
+    @type  name: C{str}
+    @return: The Matcher
+    @rtype: L{backend.Matcher}
+    '''
+    key_name = "%s:%s" % (spectrum_type, name)
+    return Matcher.get_by_key_name(key_name) or Matcher(key_name=key_name)
+
+def build_matchers(name, entries):
+    '''
+    Merge spectra into the Matchers being built by a rebuild.
+    
+    Merging a spectrum that is already in the Matcher does nothing, so a
+    batch can be merged again after failing part way. Each Matcher is
+    changed in a transaction, so batches merged at the same time do not
+    overwrite each other.
+    
+    @param name: Name of the new generation
+    @type  name: C{str}
+    @param entries: Key, spectrum type, heavyside index, peak x-values and
+    chemical name of each spectrum
+    @type  entries: C{list} of C{tuple}
+    '''
+    by_type = {}
+    for key, spectrum_type, heavyside, peaks, chemical_name in entries:
+        by_type.setdefault(spectrum_type, []).append((key, heavyside, peaks, chemical_name))
+    def merge(spectrum_type, typed):
+        matcher = get_rebuild_matcher(spectrum_type, name)
+        matcher._insert_many(typed)
+        matcher.put()
+    for spectrum_type, typed in by_type.iteritems():
+        db.run_in_transaction(merge, spectrum_type, typed)
+
+def finish_rebuild(spectrum_type, name):
+    '''
+    Switch readers over to a rebuilt Matcher, then delete the old one and
+    the changes folded into the new one.
+    
+    Every change logged since the rebuild started is replayed onto the new
+    Matcher first. Replaying a change the rebuild already saw does nothing,
+    so readers are left to replay the changes logged in the last
+    L{MatcherDelta.SETTLE_TIME} again, in case one logged earlier is stored
+    late. The switch itself is a single write of the L{backend.MatcherHead},
+    so readers get either the old Matcher or the new one, never a mix.
+    Matchers left behind by rebuilds that never finished are deleted too.
+    
+    @param spectrum_type: Type of spectrum the Matcher is for
+    @type  spectrum_type: C{str}
+    @param name: Name of the new generation
+    @type  name: C{str}
+    @raise common.ServerError: If the Matcher is being compacted, so the
+    switch should be tried again later
+    '''
+    key_name = "%s:%s" % (spectrum_type, name)
+    if not memcache.add(spectrum_type + '_compacting', True, time=60):
+        raise common.ServerError("Matcher is being compacted.")
+    try:
+        head = MatcherHead.get_by_key_name(spectrum_type)
+        if head.matcher == key_name:
+            # Already switched, but the cache may not have been updated.
+            memcache.delete(spectrum_type + '_matcher')
+        elif head.building != key_name:
+            # A newer rebuild has started, so this one is no longer needed.
+            db.delete(db.Key.from_path('Matcher', key_name))
+            return
+        else:
+            matcher = get_rebuild_matcher(spectrum_type, name)
+            matcher.compacted = head.since
+            query = MatcherDelta.all().filter('spectrum_type =', spectrum_type)
+            query.filter('created >=', head.since).order('created')
+            deltas = query.fetch(MatcherDelta.FETCH_LIMIT)
+            while deltas:
+                matcher.apply(deltas)
+                matcher.compacted = deltas[-1].created
+                deltas = query.with_cursor(query.cursor()).fetch(MatcherDelta.FETCH_LIMIT)
+            settled = datetime.datetime.now() - datetime.timedelta(seconds=MatcherDelta.SETTLE_TIME)
+            matcher.compacted = min(matcher.compacted, settled)
+            # Store the new Matcher before pointing readers at it.
+            matcher.put()
+            head.matcher = key_name
+            head.building = None
+            head.since = None
+            head.put()
+            memcache.set(spectrum_type + '_matcher', matcher)
+            memcache.set(spectrum_type + '_deltas', 0)
+        bump_generation(spectrum_type)
+    finally:
+        memcache.delete(spectrum_type + '_compacting')
+    # Drop the old Matcher, and any left by rebuilds that failed or were
+    # given up on, unless a newer rebuild is using it.
+    head = MatcherHead.get_by_key_name(spectrum_type)
+    db.delete([key for key in Matcher.all(keys_only=True)
+               if key.name() and (key.name() == spectrum_type or
+                                  key.name().startswith(spectrum_type + ":"))
+               and key.name() not in (head.matcher, head.building)])
+    # Drop the changes the new Matcher already has.
+    compacted = Matcher.get_by_key_name(key_name).compacted
+    query = MatcherDelta.all(keys_only=True).filter('spectrum_type =', spectrum_type)
+    query.filter('created <=', compacted)
+    stale = query.fetch(MatcherDelta.FETCH_LIMIT)
+    while stale:
+        db.delete(stale)
+        stale = query.fetch(MatcherDelta.FETCH_LIMIT)
+
+def get_matcher(spectrum_type):
+    '''
+    Get the Matcher for a spectrum type with all pending changes applied.
+    
+    The Matcher is kept on this instance between requests, and only reloaded
+    when its generation in the cache has changed since. Reloading reads the
+    compacted Matcher from the cache or the database, then replays every
+    L{backend.MatcherDelta} logged after its last compaction in order.
+    
+    @warning: The Matcher is shared between requests, so do not change it.
+    @param spectrum_type: Type of spectrum the Matcher is for
+    @type  spectrum_type: C{str}
+    @return: The up-to-date Matcher
+    @rtype: L{backend.Matcher}
+    '''
+    generation = get_generation(spectrum_type)
+    cached = _matchers.get(spectrum_type)
+    if cached is not None and cached[0] == generation:
+        return cached[1]
+    matcher, deltas = _load_matcher(spectrum_type)
+    matcher.apply(deltas)
+    _matchers[spectrum_type] = (generation, matcher)
+    return matcher
+
+def warmup():
+    '''
+    Load what the first requests to a new instance would otherwise have to.
+    
+    Every Matcher is loaded with its pending changes and kept on the
+    instance, and the generations that browsing and listing projects check
+    are put back in the cache if they were evicted.
+    '''
+    for spectrum_type in Spectrum.spectrum_type.choices:
+        get_matcher(spectrum_type)
+    generations("browse")
+    generations("projects")
+
+def generations(action, target="public", guess="", type=""):
+    '''
+    Get the generations of everything a browse or projects listing is made
+    from, which change whenever the listing could.
+    
+    @param action: "browse" or "projects"
+    @type  action: C{str}
+    @param target: "public" or the key of the project being browsed
+    @type  target: C{str}
+    @param guess: What the user has typed, when getting search suggestions
+    @type  guess: C{str}
+    @param type: Type of spectra to suggest, or "" for all of them
+    @type  type: C{str}
+    @return: The generations
+    @rtype: C{list} of C{int}
+    @raise common.InputError: If an invalid spectrum type is given
+    '''
+    if action == "projects":
+        names = ["projects"]
+    elif guess:
+        # Suggestions come from the Matchers.
+        names = _partitions(type or "all")
+    else:
+        names = ["project_" + target]
+    return [get_generation(name) for name in names]
+
+def get_generation(name):
+    '''
+    Get the current generation of a Matcher or project.
+    
+    @param name: Spectrum type of the Matcher, "project_" followed by the
+    key name or key of a project, or "projects" for the list of projects
+    @type  name: C{str}
+    @return: The current generation
+    @rtype: C{int}
+    '''
+    generation = memcache.get(name + '_generation')
+    if generation is None:
+        generation = bump_generation(name)
+    return generation
+
+def bump_generation(name):
+    '''
+    Mark a Matcher or project as changed on every instance.
+    
+    If the generation was evicted from the cache, it starts again from the
+    current time so it cannot match a generation loaded before.
+    
+    @param name: Spectrum type of the Matcher, "project_" followed by the
+    key name or key of a project, or "projects" for the list of projects
+    @type  name: C{str}
+    @return: The new generation
+    @rtype: C{int}
+    '''
+    generation = memcache.incr(name + '_generation')
+    if generation is None:
+        memcache.add(name + '_generation', int(time.time() * 1000))
+        generation = memcache.get(name + '_generation')
+    return generation
+
+def compact(spectrum_type, force=False):
+    '''
+    Fold the pending changes for a spectrum type back into its Matcher.
+    
+    Compaction only runs once L{Matcher.COMPACT_THRESHOLD} changes have been
+    logged since the last one, unless forced. Only one request compacts a
+    given Matcher at a time; others just leave their changes in the log.
+    
+    Changes logged less than L{MatcherDelta.SETTLE_TIME} ago are left in the
+    log, since one logged earlier may not have been stored yet. Readers keep
+    replaying them until a later compaction folds them in.
+    
+    @param spectrum_type: Type of spectrum the Matcher is for
+    @type  spectrum_type: C{str}
+    @param force: Whether to compact regardless of the number of changes
+    @type  force: C{bool}
+    @return: Whether compaction was done
+    @rtype: C{bool}
+    '''
+    pending = memcache.incr(spectrum_type + '_deltas')
+    if pending is None:
+        # Counter was evicted, so start counting again.
+        memcache.add(spectrum_type + '_deltas', 1)
+        pending = 1
+    if pending < Matcher.COMPACT_THRESHOLD and not force:
+        return False
+    if not memcache.add(spectrum_type + '_compacting', True, time=60):
+        # Somebody else is already compacting.
+        return False
+    try:
+        matcher, pending = _load_matcher(spectrum_type)
+        settled = datetime.datetime.now() - datetime.timedelta(seconds=MatcherDelta.SETTLE_TIME)
+        deltas = [delta for delta in pending if delta.created < settled]
+        if not deltas:
+            return False
+        matcher.apply(deltas)
+        matcher.compacted = deltas[-1].created
+        memcache.set(spectrum_type + '_deltas', len(pending) - len(deltas))
+        # Store the new base before dropping the deltas, so readers never
+        # see a Matcher missing changes.
+        matcher.put()
+        memcache.set(spectrum_type + '_matcher', matcher)
+        # While the Matchers are being rebuilt, keep the changes the new ones
+        # will need replayed.
+        head = MatcherHead.get_by_key_name(spectrum_type)
+        if head is not None and head.building:
+            deltas = [delta for delta in deltas if delta.created < head.since]
+        db.delete(deltas)
+        # Have every instance load the compacted Matcher in place of the one
+        # it holds.
+        bump_generation(spectrum_type)
+    finally:
+        memcache.delete(spectrum_type + '_compacting')
+    return True
+
+def _load_matcher(spectrum_type):
+    '''
+    Get the compacted Matcher for a spectrum type and its pending changes.
+    
+    @param spectrum_type: Type of spectrum the Matcher is for
+    @type  spectrum_type: C{str}
+    @return: The compacted Matcher and the changes logged since
+    @rtype: C{tuple} of L{backend.Matcher} and C{list} of L{backend.MatcherDelta}
+    '''
+    # Check cache for the Matcher. If not, get the one in use from database.
+    # If it's not there, make a new one.
+    matcher = memcache.get(spectrum_type + '_matcher')
+    if matcher is None:
+        head = MatcherHead.get_by_key_name(spectrum_type)
+        key_name = head is not None and head.matcher or spectrum_type
+        matcher = Matcher.get_by_key_name(key_name)
+        if matcher is None:
+            matcher = Matcher(key_name=key_name)
+        # Do not replace a Matcher a rebuild has just switched to.
+        memcache.add(spectrum_type + '_matcher', matcher)
+    query = MatcherDelta.all().filter('spectrum_type =', spectrum_type)
+    if matcher.compacted is not None:
+        query.filter('created >', matcher.compacted)
+    query.order('created')
+    # Page through every pending change, however many there are.
+    deltas = page = query.fetch(MatcherDelta.FETCH_LIMIT)
+    while len(page) == MatcherDelta.FETCH_LIMIT:
+        page = query.with_cursor(query.cursor()).fetch(MatcherDelta.FETCH_LIMIT)
+        deltas = deltas + page
+    return matcher, deltas
+
+def _partitions(spectrum_type):
+    '''
+    Get the spectrum types a search should go through.
+    
+    @param spectrum_type: A spectrum type, or "all" for every type
+    @type  spectrum_type: C{str}
+    @return: Spectrum types to search
+    @rtype: C{list} of C{str}
+    @raise common.InputError: If an invalid spectrum type is given
+    '''
+    if spectrum_type == "all":
+        return list(Spectrum.spectrum_type.choices)
+    if spectrum_type not in Spectrum.spectrum_type.choices:
+        raise common.InputError(spectrum_type, "Invalid spectrum type.")
+    return [spectrum_type]
+
+def _merge(items, new):
+    '''
+    Merge new items into a sorted list in place.
+    
+    A few items are inserted one at a time by bisection. More are appended
+    and the list sorted again, which the built-in sort does in about linear
+    time, since the list is then just two sorted runs.
+    
+    @param items: Sorted list to merge into
+    @type  items: C{list}
+    @param new: Items to merge, in any order
+    @type  new: C{list}
+    '''
+    if len(new) <= Matcher.INSORT_LIMIT:
+        for item in new:
+            bisect.insort(items, item)
+    else:
+        items.extend(new)
+        items.sort()
+
+def _remove_sorted(items, item):
+    '''
+    Remove an item from a sorted list, finding it by bisection.
+    
+    @param items: Sorted list to remove from
+    @type  items: C{list}
+    @param item: Item to remove
+    @type  item: Anything
+    @return: Whether the item was found
+    @rtype: C{bool}
+    '''
+    index = bisect.bisect_left(items, item)
+    if index < len(items) and items[index] == item:
+        del items[index]
+        return True
+    return False
+
+def _trigrams(name):
+    '''
+    Split a chemical name into its case-insensitive three-letter sequences.
+    
+    @param name: Name to split
+    @type  name: C{str}
+    @return: Set of trigrams, padded so word starts count more
+    @rtype: C{set} of C{str}
+    '''
+    padded = "  %s " % (name or "").lower()
+    return set([padded[i:i + 3] for i in xrange(len(padded) - 2)])
 
 def auth(user, project, action):
     '''
@@ -267,7 +1096,7 @@ class Spectrum(db.Model):
     chemical_type = db.StringProperty()
     '''The chemical type of the substance the spectrum represents
     @type: C{str}'''
-
+    
     spectrum_type = db.StringProperty(choices=["infrared", "raman"])
     '''The spectrum type of the substance the spectrum represents
     @type: C{str}'''
@@ -280,6 +1109,15 @@ class Spectrum(db.Model):
     '''A list of y points for the spectrum's graph
     @type: C{list}'''
     
+    RESOLUTIONS = (32, 128)
+    '''Coarser resolutions candidates are ranked at first, coarsest first
+    @type: C{tuple}'''
+    
+    coarse_data = db.ListProperty(float, indexed=False)
+    '''The integrated data downsampled to each of L{RESOLUTIONS}, one after
+    the other, so searches can rank candidates without summing their data
+    @type: C{list}'''
+    
     notes = db.StringProperty(indexed=False)
     '''Notes on the spectrum if in a private database
     @type: C{str}'''
@@ -297,7 +1135,7 @@ class Spectrum(db.Model):
         @type  contents: C{unicode} or C{str}
         '''
         self.contents = contents
-        self.spectrum_type = 'infrared' # Later this will be variable
+        self.spectrum_type = 'infrared' # Unless the file header says otherwise
         
         '''
         The following block of code interprets GRAMS file types
@@ -314,6 +1152,7 @@ class Spectrum(db.Model):
         ftflgs = f.read(1) #ftflgs == null means that the data is single-file, and is stored with evenly spaced x data
         fversn = f.read(1) #fversn determines if the file is MSB 1st, LSB 1st, or 'old-format' (L, K, M respectively)
         GRAMS = False #Is it a grams file?
+        fexper = None
         if(ftflgs == '\0'):
             if(fversn == 'K'):
                 GRAMS = True
@@ -344,7 +1183,7 @@ class Spectrum(db.Model):
                 f.seek(544,0) #Skip the next 544 bytes, as they are the rest of the header
                 a = array.array('f')
                 a.fromstring(f.read(numpoints * 4))
-                
+            
             elif(fversn == 'L'):
                 fexper = contents[2]
                 #Code executing here is for GRAMS files that are "MSB 1st" and "new format".
@@ -364,7 +1203,7 @@ class Spectrum(db.Model):
             pass
             #The GRAMS file is multi-file or something like that.
             #Until we add file-extension support, multi-file GRAMS will throw errors!!
-
+        
         x = float(self.get_field('##FIRSTX=')) # The first x-value
         if GRAMS:
             delta_x = (lastx - firstx)/(numpoints - 1)
@@ -413,16 +1252,81 @@ class Spectrum(db.Model):
                 break #If finished, break
             old_x, old_y = x, y #Otherwise keep going
         self.data = data
+        self.coarse_data = []
+        for bins in self.RESOLUTIONS:
+            self.coarse_data.extend(metrics.downsample(data, bins))
         scale = 300/max(data)
         self.graph_data = [d*scale for d in data]
         self.xy = xy
         self.chemical_type = 'Unknown' # We will find this later (maybe)
+        # Detect the spectrum type from the file header.
+        if GRAMS:
+            if fexper == chr(11): # SPCRMN
+                self.spectrum_type = 'raman'
+        elif re.search(r'##DATA ?TYPE=[^\r\n]*RAMAN', self.contents, re.IGNORECASE):
+            self.spectrum_type = 'raman'
         # FIXME: Assumes chemical name is in TITLE label.
         if GRAMS: self.chemical_name = 'Unknown'
         else:
             self.chemical_name = self.get_field('##TITLE=')
         # Reference: http://www.jcamp-dx.org/
     
+    def downsampled(self, bins):
+        '''
+        Get the integrated data summed down to fewer bins.
+        
+        The sums are stored in L{coarse_data} when the spectrum is parsed.
+        Spectra stored before then have them worked out from the data.
+        
+        @param bins: One of L{RESOLUTIONS}
+        @type  bins: C{int}
+        @return: The downsampled data
+        @rtype: C{list} of C{float}
+        '''
+        if not self.coarse_data:
+            return metrics.downsample(self.data, bins)
+        start = 0
+        for resolution in self.RESOLUTIONS:
+            # Same number of groups as metrics.downsample makes.
+            group = int(math.ceil(float(len(self.data)) / resolution))
+            size = int(math.ceil(float(len(self.data)) / group))
+            if resolution == bins:
+                return self.coarse_data[start:start + size]
+            start += size
+        return metrics.downsample(self.data, bins)
+    
+    def preprocessed(self, stage=None):
+        '''
+        Get the integrated data after a preprocessing stage.
+        
+        Stored spectra keep their preprocessed data in a L{SpectrumStages}
+        child, which L{load_stages} fetches for a batch of them. Anything not
+        loaded or stored is worked out the first time it is asked for.
+        
+        @param stage: Name of the stage, or None for the raw data
+        @type  stage: C{str}
+        @return: The preprocessed data
+        @rtype: C{list} of C{float}
+        @raise common.InputError: If an invalid stage is given
+        '''
+        if stage is None:
+            return self.data
+        function = preprocessing.get(stage)
+        if not hasattr(self, 'stages'):
+            self.stages = {}
+        if stage not in self.stages:
+            self.stages[stage] = function(self.data)
+        return self.stages[stage]
+    
+    def stages_key(self):
+        '''
+        Get the key of the stored preprocessed data of the spectrum.
+        
+        @return: Key of its L{SpectrumStages}
+        @rtype: L{google.appengine.ext.db.Key}
+        '''
+        return db.Key.from_path('SpectrumStages', 'stages', parent=self.key())
+    
     def get_field(self, name):
         '''
         Get a specific data field from the file.
@@ -433,7 +1337,7 @@ class Spectrum(db.Model):
         @rtype: C{str}
         '''
         return re.search(name+'([^\\r\\n]+)', self.contents).group(1)
-     
+    
     def calculate_peaks(self, one=False):
         '''
         Calculate the peaks for a spectrum.
@@ -443,6 +1347,11 @@ class Spectrum(db.Model):
         @return: Either a list of peaks or one peak, depending on the parameter
         @rtype: C{list} or C{float}
         '''
+        if not hasattr(self, 'xy'):
+            # Spectra loaded from the database only keep their integrated
+            # data, so use the middle of each integral as its x-value.
+            width = (3900.0 - 700.0) / len(self.data)
+            self.xy = [(700.0 + (i + 0.5) * width, y) for i, y in enumerate(self.data)]
         if one:
             return max(self.xy, key=operator.itemgetter(1))[0]
         self.xy = sorted(self.xy, key=operator.itemgetter(1), reverse=True)
@@ -460,7 +1369,7 @@ class Spectrum(db.Model):
         @rtype: C{int}
         '''
         key, left_edge, width = 0, 0, len(self.data) # Initialize variables
-
+        
         for bit in xrange(Matcher.FLAT_HEAVYSIDE_BITS):
             left = sum(self.data[left_edge:left_edge + width / 2])
             right = sum(self.data[left_edge + width / 2:left_edge + width])
@@ -473,6 +1382,28 @@ class Spectrum(db.Model):
         return key
 
 
+class SpectrumStages(db.Model):
+    '''
+    Store the preprocessed data of a spectrum, as a child keyed "stages".
+    
+    It is kept apart from the spectrum so fetching candidates only loads the
+    integrated data, and the preprocessed data is only fetched when a search
+    or comparison asks for a stage.
+    '''
+    
+    baseline_data = db.ListProperty(float, indexed=False)
+    '''The integrated y values with their baseline removed
+    @type: C{list}'''
+    
+    derivative_data = db.ListProperty(float, indexed=False)
+    '''The first derivative of the integrated y values
+    @type: C{list}'''
+    
+    normalized_data = db.ListProperty(float, indexed=False)
+    '''The integrated y values scaled to unit length
+    @type: C{list}'''
+
+
 class Project(db.Model):
     '''
     Store a user's spectrum project, where different users have
@@ -499,6 +1430,18 @@ class Project(db.Model):
     spectra = db.ListProperty(db.Key)
     '''Spectra included in this project.
     @type: L{backend.Spectrm}'''
+    
+    def put(self):
+        '''
+        Store the project and mark it, and the list of projects, as changed.
+        
+        @return: The project's key
+        @rtype: L{google.appengine.ext.db.Key}
+        '''
+        key = super(Project, self).put()
+        bump_generation("project_" + (key.name() or str(key)))
+        bump_generation("projects")
+        return key
 
 
 class Matcher(db.Model):
@@ -531,6 +1474,37 @@ class Matcher(db.Model):
     '''@ivar: List of all spectra in this spectrum type
     @type: L{common.DictProperty}'''
     
+    spectrum_index = common.DictProperty(indexed=False)
+    '''@ivar: Heavyside index, peaks and chemical name of each spectrum key,
+    so its entries can be found again without scanning
+    @type: L{common.DictProperty}'''
+    
+    name_trigrams = common.DictProperty(indexed=False)
+    '''@ivar: Spectra whose chemical names contain each three-letter sequence
+    @type: L{common.DictProperty}'''
+    
+    compacted = db.DateTimeProperty(indexed=False)
+    '''@ivar: Creation time of the last L{backend.MatcherDelta} folded in
+    @type: C{datetime.datetime}'''
+    
+    COMPACT_THRESHOLD = 100
+    '''Number of logged changes after which the Matcher is compacted
+    @type: C{int}'''
+    
+    BATCH_SIZE = 500
+    '''Number of spectra merged at once when rebuilding the Matcher
+    @type: C{int}'''
+    
+    INSORT_LIMIT = 16
+    '''Number of peaks or names up to which they are inserted into the
+    sorted lists one at a time, rather than sorting the lists again
+    @type: C{int}'''
+    
+    TRIGRAM_SIMILARITY = 0.5
+    '''Fraction of a guess's trigrams a chemical name must contain to be
+    suggested for it
+    @type: C{float}'''
+    
     def add(self, spectrum):
         '''
         Add a new spectrum to the Matcher.
@@ -542,41 +1516,152 @@ class Matcher(db.Model):
         @param spectrum: The spectrum to add
         @type  spectrum: L{backend.Spectrum}
         '''
-        #Flat heavyside: hash table of heavyside keys
-        key = spectrum.calculate_heavyside()
-        if key in self.flat_heavyside:
-            self.flat_heavyside[key].add(spectrum.key())
-        else:
-            self.flat_heavyside[key] = set([spectrum.key()])
+        self.add_many([spectrum])
+    
+    def add_many(self, spectra):
+        '''
+        Add a batch of new spectra to the Matcher.
+        
+        Find the features of every spectrum first, then merge them all into
+        the sorted data structures in one pass. This is much faster than
+        calling L{add} for each spectrum, since every insertion into a sorted
+        list has to shift the whole list.
+        
+        @param spectra: The spectra to add
+        @type  spectra: C{list} of L{backend.Spectrum}
+        '''
+        self._insert_many([(spectrum.key(), spectrum.calculate_heavyside(),
+                            spectrum.calculate_peaks(), spectrum.chemical_name)
+                           for spectrum in spectra])
+    
+    def delete(self, key):
+        '''
+        Delete a spectrum from the Matcher.
         
+        @param key: Key of the spectrum to delete
+        @type  key: L{google.appengine.ext.db.Key}
+        '''
+        if not self.spectrum_index and self.chemical_names:
+            self._build_index()
+        entry = self.spectrum_index.pop(key, None)
+        if entry is None:
+            return
+        heavyside, peaks, chemical_name = entry
+        # Remove it from the heavyside keys, peak list and chemical names,
+        # finding each entry by bisection.
+        spectra = self.flat_heavyside.get(heavyside)
+        if spectra is not None:
+            spectra.discard(key)
+            if not spectra:
+                del self.flat_heavyside[heavyside]
+        for peak in peaks:
+            _remove_sorted(self.peak_list, (peak, key))
+        _remove_sorted(self.chemical_names, (chemical_name, key))
+        for trigram in _trigrams(chemical_name):
+            spectra = self.name_trigrams.get(trigram)
+            if spectra is not None:
+                spectra.discard(key)
+                if not spectra:
+                    del self.name_trigrams[trigram]
+    
+    def apply(self, deltas):
+        '''
+        Replay logged changes on the Matcher in order.
+        
+        @param deltas: Changes to replay, oldest first
+        @type  deltas: C{list} of L{backend.MatcherDelta}
+        '''
+        # Merge runs of consecutive additions in one go.
+        added = []
+        for delta in deltas:
+            key = MatcherDelta.spectrum.get_value_for_datastore(delta)
+            if delta.operation == "add":
+                added.append((key, delta.heavyside, delta.peaks, delta.chemical_name))
+            else:
+                self._insert_many(added)
+                added = []
+                self.delete(key)
+        self._insert_many(added)
+    
+    def _insert_many(self, entries):
+        '''
+        Add precomputed spectrum features to the Matcher data structures.
+        
+        @param entries: Key, heavyside index, peak x-values and chemical name
+        of each spectrum
+        @type  entries: C{list} of C{tuple}
+        '''
+        if not entries:
+            return
+        if not self.spectrum_index and self.chemical_names:
+            self._build_index()
+        peaks, names = [], []
+        for key, heavyside, spectrum_peaks, chemical_name in entries:
+            if key in self.spectrum_index:
+                # Already indexed, e.g. a change replayed twice.
+                continue
+            self.spectrum_index[key] = (heavyside, tuple(spectrum_peaks), chemical_name)
+            for trigram in _trigrams(chemical_name):
+                if trigram in self.name_trigrams:
+                    self.name_trigrams[trigram].add(key)
+                else:
+                    self.name_trigrams[trigram] = set([key])
+            #Flat heavyside: hash table of heavyside keys
+            if heavyside in self.flat_heavyside:
+                self.flat_heavyside[heavyside].add(key)
+            else:
+                self.flat_heavyside[heavyside] = set([key])
+            peaks.extend([(peak, key) for peak in spectrum_peaks])
+            names.append((chemical_name, key))
         #peak_list - positions of highest peaks:
-        for peak in spectrum.calculate_peaks():
-            bisect.insort(self.peak_list, (peak, spectrum.key()))
-        bisect.insort(self.chemical_names, (spectrum.chemical_name, spectrum.key()))
+        _merge(self.peak_list, peaks)
+        _merge(self.chemical_names, names)
     
-    def delete(self, spectrum):
+    def _build_index(self):
         '''
-        Delete a spectrum to the Matcher.
+        Rebuild the reverse index from the other data structures.
         
-        @param spectrum: The spectrum to add
-        @type  spectrum: L{backend.Spectrum}
+        Only needed once for Matchers stored before the reverse index existed.
         '''
-        # Remove it from the heavyside keys and peak lists.
-        [key.discard(spectrum) for spectrum in self.flat_heavyside]
-        [self.flat_heavyside.remove(peak) for peak in self.peak_list if x[1] == spectrum]
+        index = {}
+        for heavyside, spectra in self.flat_heavyside.iteritems():
+            for key in spectra:
+                index[key] = [heavyside, [], None]
+        for peak, key in self.peak_list:
+            index.setdefault(key, [None, [], None])[1].append(peak)
+        for chemical_name, key in self.chemical_names:
+            index.setdefault(key, [None, [], None])[2] = chemical_name
+        self.spectrum_index = dict((key, (heavyside, tuple(peaks), chemical_name))
+                                   for key, (heavyside, peaks, chemical_name)
+                                   in index.iteritems())
+        self.name_trigrams = {}
+        for chemical_name, key in self.chemical_names:
+            for trigram in _trigrams(chemical_name):
+                self.name_trigrams.setdefault(trigram, set()).add(key)
     
     def get(self, spectrum):
         '''
         Find spectra similar to the given one.
         
+        @param spectrum: The spectrum to search for
+        @type  spectrum: L{backend.Spectrum}
+        @return: List of similar spectra
+        @rtype: C{list} of L{backend.Spectrum}
+        '''
+        return Spectrum.get(self.candidates(spectrum))
+    
+    def candidates(self, spectrum):
+        '''
+        Find the keys of spectra similar to the given one.
+        
         Find spectra that may represent the given Spectrum object by sorting
         the database using different heuristics, having them vote, and 
         returning only the spectra deemed similar to the given spectrum.
         
         @param spectrum: The spectrum to search for
         @type  spectrum: L{backend.Spectrum}
-        @return: List of similar spectra
-        @rtype: C{list} of L{backend.Spectrum}
+        @return: Keys of similar spectra, most votes first
+        @rtype: C{list} of L{google.appengine.ext.db.Key}
         '''
         # Get heavyside key and peaks.
         flatHeavysideKey = spectrum.calculate_heavyside()
@@ -600,15 +1685,85 @@ class Matcher(db.Model):
             # Give the spectrum (5 - offest) votes
             peak_index = self.peak_list[index+offset][1]
             keys[peak_index] = keys.get(peak_index, 0) + (5 - abs(offset))
-            
-        # Sort candidates by number of votes and return Spectrum objects.
+        
+        # Sort candidates by number of votes and return their keys.
         keys = sorted(keys.iteritems(), key=operator.itemgetter(1), reverse=True)
         
-        return Spectrum.get([k[0] for k in keys])
+        return [k[0] for k in keys]
     
-    def browse(self, chemical_name):
-        keys = [key for name, key in self.chemical_names if name.startswith(chemical_name)]
-        return Spectrum.get(keys)
+    def browse(self, chemical_name, limit=10):
+        '''
+        Find spectra whose chemical names match what the user has typed.
+        
+        @param chemical_name: What the user has typed so far
+        @type  chemical_name: C{str}
+        @param limit: Maximum number of spectra to return
+        @type  limit: C{int}
+        @return: List of matching spectra
+        @rtype: C{list} of L{backend.Spectrum}
+        '''
+        return Spectrum.get(self.suggest(chemical_name, limit))
+    
+    def suggest(self, chemical_name, limit=10):
+        '''
+        Find the keys of spectra whose chemical names match what the user
+        has typed.
+        
+        Names starting with the given text come first, found by bisection
+        since the chemical names are kept sorted. If there are not enough of
+        those, fill up with names sharing enough trigrams with the text, which
+        catches substrings and typos.
+        
+        @param chemical_name: What the user has typed so far
+        @type  chemical_name: C{str}
+        @param limit: Maximum number of keys to return
+        @type  limit: C{int}
+        @return: Keys of matching spectra, best matches first
+        @rtype: C{list} of L{google.appengine.ext.db.Key}
+        '''
+        # Prefix matches are a contiguous range of the sorted names.
+        keys = []
+        index = bisect.bisect_left(self.chemical_names, (chemical_name,))
+        while len(keys) < limit and index < len(self.chemical_names):
+            name, key = self.chemical_names[index]
+            if not name.startswith(chemical_name):
+                break
+            keys.append(key)
+            index += 1
+        if len(keys) < limit:
+            keys.extend([key for key in self._similar_names(chemical_name)
+                         if key not in keys][:limit - len(keys)])
+        return keys
+    
+    def _similar_names(self, chemical_name):
+        '''
+        Find spectra with chemical names similar to the given one.
+        
+        Only spectra sharing at least one trigram with the name are looked
+        at. They are ranked by how many of the name's trigrams they contain,
+        then by the Jaccard similarity of their trigrams.
+        
+        @param chemical_name: Name to look for
+        @type  chemical_name: C{str}
+        @return: Keys of similar spectra, most similar first
+        @rtype: C{list} of L{google.appengine.ext.db.Key}
+        '''
+        if not self.name_trigrams and self.chemical_names:
+            self._build_index()
+        trigrams = _trigrams(chemical_name)
+        shared = {}
+        for trigram in trigrams:
+            for key in self.name_trigrams.get(trigram, ()):
+                shared[key] = shared.get(key, 0) + 1
+        scores = []
+        for key, count in shared.iteritems():
+            contained = float(count) / len(trigrams)
+            if contained >= self.TRIGRAM_SIMILARITY:
+                name_trigrams = len(_trigrams(self.spectrum_index[key][2]))
+                jaccard = float(count) / (len(trigrams) + name_trigrams - count)
+                scores.append((contained, jaccard, key))
+        scores.sort(reverse=True)
+        return [key for contained, jaccard, key in scores]
     
     @staticmethod # Make a static method for faster execution
     def bove(a, b):
@@ -624,16 +1779,13 @@ class Matcher(db.Model):
         @rtype: C{float}
         @raise common.ServerError: If there are invalid spectra in the database
         '''
-        length = min([len(a.data), len(b.data)])
-        if length == 0 or a.data is None or b.data is None:
-            raise common.ServerError("Invalid spectra in the database.")
-        return max([abs(a.data[i] - b.data[i]) for i in xrange(length)])
+        return metrics.score("bove", a.data, [b.data])[0]
     
     @staticmethod # Make a static method for faster execution
     def least_squares(a, b):
         '''
-        Calculate the difference or error between two spectra using Bove's
-        algorithm.
+        Calculate the difference or error between two spectra using the sum
+        of the squared differences.
         
         @param a: Spectrum to compare
         @type  a: L{backend.Spectrum}
@@ -643,7 +1795,126 @@ class Matcher(db.Model):
         @rtype: C{float}
         @raise common.ServerError: If there are invalid spectra in the database
         '''
-        length = min([len(a.data), len(b.data)])
-        if length == 0 or a.data is None or b.data is None:
-            raise common.ServerError("Invalid spectra in the database.")
-        return sum([(a.data[i] - a.data[i])**2 for i in xrange(length)])
+        return metrics.score("leastsquares", a.data, [b.data])[0]
+
+
+class MatcherHead(db.Model):
+    '''
+    Point readers at the Matcher in use for a spectrum type, keyed by the
+    spectrum type.
+    
+    Rebuilding the Matchers builds a new generation of them beside the ones
+    in use, keyed by spectrum type and generation, then switches each head
+    over to the new one in a single write. Matchers stored before there
+    were heads are keyed by spectrum type alone.
+    '''
+    
+    REPLAY_MARGIN = 60
+    '''Number of seconds before a rebuild starts from which changes are
+    replayed onto the new Matchers
+    @type: C{int}'''
+    
+    matcher = db.StringProperty(indexed=False)
+    '''Key name of the Matcher in use
+    @type: C{str}'''
+    
+    building = db.StringProperty(indexed=False)
+    '''Key name of the Matcher being rebuilt, if any
+    @type: C{str}'''
+    
+    since = db.DateTimeProperty(indexed=False)
+    '''When changes started being kept for the Matcher being rebuilt
+    @type: C{datetime.datetime}'''
+
+class MatcherDelta(db.Model):
+    '''
+    Store a single change to a Matcher that has not been compacted yet.
+    
+    Adding or deleting a public spectrum only writes one of these instead of
+    the whole Matcher. Readers replay them over the compacted Matcher, and
+    L{backend.compact} folds them back in once enough have accumulated.
+    '''
+    
+    FETCH_LIMIT = 1000
+    '''Number of changes fetched at once when replaying them
+    @type: C{int}'''
+    
+    SETTLE_TIME = 60
+    '''Number of seconds after being logged before a change is folded into
+    its Matcher. A change is timestamped before it is stored, and instances'
+    clocks differ, so a change logged earlier than one already stored can
+    still turn up for a little while.
+    @type: C{int}'''
+    
+    spectrum_type = db.StringProperty(choices=["infrared", "raman"])
+    '''Type of spectrum the changed Matcher is for
+    @type: C{str}'''
+    
+    operation = db.StringProperty(choices=["add", "delete"], indexed=False)
+    '''Whether the spectrum was added or deleted
+    @type: C{str}'''
+    
+    spectrum = db.ReferenceProperty(Spectrum, indexed=False)
+    '''The spectrum that was changed
+    @type: L{backend.Spectrum}'''
+    
+    heavyside = db.IntegerProperty(indexed=False)
+    '''Heavyside index of an added spectrum
+    @type: C{int}'''
+    
+    peaks = db.ListProperty(float, indexed=False)
+    '''X-values of the highest peaks of an added spectrum
+    @type: C{list}'''
+    
+    chemical_name = db.StringProperty(indexed=False)
+    '''Chemical name of an added spectrum
+    @type: C{str}'''
+    
+    created = db.DateTimeProperty(auto_now_add=True)
+    '''When the change was logged
+    @type: C{datetime.datetime}'''
+    
+    @classmethod
+    def log_add(cls, spectrum):
+        '''
+        Log the addition of a spectrum.
+        
+        @param spectrum: The spectrum that was added
+        @type  spectrum: L{backend.Spectrum}
+        @return: The logged change
+        @rtype: L{backend.MatcherDelta}
+        '''
+        return cls.log_add_many([spectrum])[0]
+    
+    @classmethod
+    def log_add_many(cls, spectra):
+        '''
+        Log the addition of a batch of spectra in one write.
+        
+        @param spectra: The spectra that were added
+        @type  spectra: C{list} of L{backend.Spectrum}
+        @return: The logged changes
+        @rtype: C{list} of L{backend.MatcherDelta}
+        '''
+        deltas = [cls(spectrum_type=spectrum.spectrum_type, operation="add",
+                      spectrum=spectrum, heavyside=spectrum.calculate_heavyside(),
+                      peaks=spectrum.calculate_peaks(),
+                      chemical_name=spectrum.chemical_name)
+                  for spectrum in spectra]
+        db.put(deltas)
+        return deltas
+    
+    @classmethod
+    def log_delete(cls, spectrum):
+        '''
+        Log the deletion of a spectrum.
+        
+        @param spectrum: The spectrum being deleted
+        @type  spectrum: L{backend.Spectrum}
+        @return: The logged change
+        @rtype: L{backend.MatcherDelta}
+        '''
+        delta = cls(spectrum_type=spectrum.spectrum_type, operation="delete",
+                    spectrum=spectrum)
+        delta.put()
+        return delta
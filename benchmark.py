@@ -0,0 +1,284 @@
+"""
+Time parsing, adding, searching, comparing and updating against synthetic
+spectrum libraries of different sizes, and write the results out as JSON so
+they can be compared between releases.
+
+Usage:
+./benchmark.py [options] <sdk>
+ - sdk : Path to the Google App Engine SDK
+
+Options:
+ - --sizes : Comma-separated library sizes (defaults to 1000,10000,100000)
+ - --queries : Number of searches and comparisons timed per size
+ - --output : File to write the results to (defaults to benchmark.json)
+ - --seed : Seed for the synthetic spectra
+
+The spectra are made from jcamp-test.jdx by shifting it by a few points,
+scaling it, adding noise and adding a few peaks of random height and width
+at random places, so each spectrum is different but realistic. One in five is
+a Raman spectrum. Everything runs in this process against the SDK's local
+datastore and memcache stubs, with a fresh datastore for every size.
+
+NOTE: The stubs keep the whole datastore in memory, and the library is
+parsed one spectrum at a time, so 100000 spectra take a few gigabytes and
+about an hour.
+
+@organization: The Cooper Union for the Advancement of the Science and the Arts
+@license: http://opensource.org/licenses/lgpl-3.0.html GNU Lesser General Public License v3.0
+@copyright: Copyright (c) 2010, Cooper Union (Some Right Reserved)
+"""
+
+import os
+import re
+import sys
+import math
+import time
+import random
+import optparse
+
+APP_ID = "cooper-redhen"
+"""Application ID the stubs are set up for."""
+
+PREFIXES = ["", "methyl", "ethyl", "propyl", "chloro", "bromo", "iodo",
+            "fluoro", "nitro", "amino", "hydroxy", "dimethyl", "trichloro"]
+"""Prefixes synthetic chemical names are made from."""
+
+BASES = ["benzene", "toluene", "phenol", "aniline", "pyridine", "acetone",
+         "naphthalene", "cyclohexane", "ethanol", "benzoic acid", "acetate",
+         "furan"]
+"""Base names synthetic chemical names are made from."""
+
+def setup_stubs(sdk):
+    """
+    Point the App Engine APIs at fresh local stubs, with an empty datastore
+    and memcache.
+    
+    @param sdk: Path to the Google App Engine SDK
+    @type  sdk: C{str}
+    """
+    if sdk not in sys.path:
+        sys.path.insert(0, sdk)
+        sys.path.insert(0, os.path.join(sdk, "lib", "django"))
+        sys.path.insert(0, os.path.join(sdk, "lib", "webob"))
+        sys.path.insert(0, os.path.join(sdk, "lib", "yaml", "lib"))
+    from google.appengine.api import apiproxy_stub_map, datastore_file_stub
+    from google.appengine.api.memcache import memcache_stub
+    os.environ["APPLICATION_ID"] = APP_ID
+    os.environ.setdefault("AUTH_DOMAIN", "gmail.com")
+    os.environ.setdefault("USER_EMAIL", "")
+    apiproxy_stub_map.apiproxy = apiproxy_stub_map.APIProxyStubMap()
+    apiproxy_stub_map.apiproxy.RegisterStub(
+        "datastore_v3", datastore_file_stub.DatastoreFileStub(APP_ID, None, None))
+    apiproxy_stub_map.apiproxy.RegisterStub("memcache", memcache_stub.MemcacheServiceStub())
+
+class Generator(object):
+    """Make synthetic JCAMP files by perturbing jcamp-test.jdx."""
+    
+    def __init__(self, template, seed=0):
+        """
+        Read the template spectrum.
+        
+        @param template: Contents of the JCAMP file to perturb
+        @type  template: C{str}
+        @param seed: Seed for the random perturbations
+        @type  seed: C{int}
+        """
+        self.random = random.Random(seed)
+        self.header, body = template.split("##XYDATA=(X++(Y..Y))")
+        self.first_x = float(get_field(template, "##FIRSTX="))
+        self.delta_x = float(get_field(template, "##DELTAX="))
+        self.y = []
+        for line in body.splitlines():
+            if line.startswith("##"):
+                break
+            values = line.split("+")
+            if len(values) > 1:
+                self.y.extend([int(value) for value in values[1:]])
+        self.peak = max(self.y)
+    
+    def spectrum(self, index):
+        """
+        Make one synthetic spectrum.
+        
+        @param index: Number of the spectrum, used in its name
+        @type  index: C{int}
+        @return: The contents of the JCAMP file
+        @rtype: C{str}
+        """
+        rnd = self.random
+        shift = rnd.randint(-5, 5)
+        scale = rnd.uniform(0.5, 1.5)
+        length = len(self.y)
+        y = [self.y[min(max(i + shift, 0), length - 1)] * scale for i in xrange(length)]
+        for peak in xrange(rnd.randint(1, 4)):
+            centre = rnd.uniform(0, length)
+            width = rnd.uniform(2, 30)
+            height = rnd.uniform(0.05, 1.0) * self.peak
+            for i in xrange(max(0, int(centre - 4 * width)),
+                            min(length, int(centre + 4 * width))):
+                y[i] += height * math.exp(-((i - centre) / width) ** 2)
+        noise = 0.005 * self.peak
+        y = [max(0, int(value + rnd.gauss(0, noise))) for value in y]
+        name = "%s%s %d" % (rnd.choice(PREFIXES), rnd.choice(BASES), index)
+        header = self.header.replace("##TITLE=iodobenzene1", "##TITLE=" + name)
+        if rnd.random() < 0.2:
+            header = header.replace("INFRARED SPECTRUM", "RAMAN SPECTRUM")
+        lines = []
+        for start in xrange(0, length, 8):
+            x = self.first_x + start * self.delta_x
+            lines.append("%d+%s" % (x, "+".join([str(value) for value in y[start:start + 8]])))
+        return "%s##XYDATA=(X++(Y..Y))\n%s\n##END=\n" % (header, "\n".join(lines))
+
+def get_field(contents, name):
+    """
+    Get a specific data label from the file.
+    
+    @param contents: Contents of the JCAMP file
+    @type  contents: C{str}
+    @param name: Name of data label to retrieve
+    @type  name: C{str}
+    @return: Value of the data label
+    @rtype: C{str}
+    """
+    return re.search(re.escape(name) + "([^\r\n]+)", contents).group(1).strip()
+
+def summarize(times):
+    """
+    Summarize a list of timings.
+    
+    @param times: Number of seconds each run took
+    @type  times: C{list} of C{float}
+    @return: Count, total, mean, median, 95th and 99th percentiles
+    @rtype: C{dict}
+    """
+    times = sorted(times)
+    if not times:
+        return {"count": 0}
+    def percentile(fraction):
+        return times[min(len(times) - 1, int(fraction * len(times)))]
+    return {"count": len(times), "total": sum(times), "mean": sum(times) / len(times),
+            "p50": percentile(0.5), "p95": percentile(0.95), "p99": percentile(0.99)}
+
+def timed(function, *args):
+    """
+    Run a function and time it.
+    
+    @param function: Function to run
+    @type  function: C{function}
+    @return: Number of seconds it took and what it returned
+    @rtype: C{tuple}
+    """
+    start = time.time()
+    result = function(*args)
+    return time.time() - start, result
+
+def run(sdk, size, queries, generator):
+    """
+    Build a library of the given size and time every operation on it.
+    
+    @param sdk: Path to the Google App Engine SDK
+    @type  sdk: C{str}
+    @param size: Number of spectra in the library
+    @type  size: C{int}
+    @param queries: Number of searches and comparisons to time
+    @type  queries: C{int}
+    @param generator: Where the synthetic spectra come from
+    @type  generator: L{Generator}
+    @return: Summaries of the timings by operation
+    @rtype: C{dict}
+    """
+    setup_stubs(sdk)
+    from google.appengine.ext import db
+    from google.appengine.api import memcache
+    import backend
+    backend._matchers.clear()
+    results = {}
+    # Parse every spectrum, storing them in batches.
+    parse_times = []
+    spectra = []
+    batch = []
+    for index in xrange(size):
+        spectrum = backend.Spectrum()
+        seconds, result = timed(spectrum.parse_string, generator.spectrum(index))
+        parse_times.append(seconds)
+        # The raw file and points are not stored, so do not keep them around.
+        del spectrum.contents, spectrum.xy
+        batch.append(spectrum)
+        if len(batch) == backend.Matcher.BATCH_SIZE:
+            db.put(batch)
+            spectra.extend(batch)
+            batch = []
+    db.put(batch)
+    spectra.extend(batch)
+    results["parse"] = summarize(parse_times)
+    # Add every spectrum to the Matcher for its type one at a time.
+    matchers = {}
+    add_times = []
+    for spectrum in spectra:
+        matcher = matchers.get(spectrum.spectrum_type)
+        if matcher is None:
+            matcher = matchers[spectrum.spectrum_type] = backend.Matcher(
+                key_name=spectrum.spectrum_type)
+        add_times.append(timed(matcher.add, spectrum)[0])
+    results["matcher_add"] = summarize(add_times)
+    project = backend.Project.get_or_insert("public")
+    project.spectra = [spectrum.key() for spectrum in spectra]
+    project.put()
+    del spectra
+    for spectrum_type, matcher in matchers.iteritems():
+        matcher.put()
+        memcache.set(spectrum_type + "_matcher", matcher)
+        backend.bump_generation(spectrum_type)
+    del matchers
+    # Search for spectra like ones in the library, but not in it.
+    uploads = [generator.spectrum(size + index) for index in xrange(queries)]
+    for name, k in (("search", None), ("search_top10", 10)):
+        backend.search(uploads[0], None, "bove", k) # Load the Matchers.
+        results[name] = summarize([timed(backend.search, upload, None, "bove", k)[0]
+                                   for upload in uploads])
+    results["search_batch"] = summarize([timed(backend.search_many, uploads)[0]])
+    # Compare uploads to each other, ten at a time.
+    groups = [uploads[start:start + 10] for start in xrange(0, len(uploads), 10)]
+    for mode in ("first", "matrix"):
+        results["compare_" + mode] = summarize(
+            [timed(backend.compare, group, "bove", mode)[0] for group in groups])
+    results["update"] = summarize([timed(backend.update)[0]])
+    return results
+
+def main():
+    """Run the benchmarks given on the command line and write the results."""
+    parser = optparse.OptionParser(usage="%prog [options] <sdk>")
+    parser.add_option("--sizes", default="1000,10000,100000",
+                      help="comma-separated library sizes")
+    parser.add_option("--queries", type="int", default=50,
+                      help="searches and comparisons timed per size")
+    parser.add_option("--output", default="benchmark.json",
+                      help="file to write the results to")
+    parser.add_option("--seed", type="int", default=0,
+                      help="seed for the synthetic spectra")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Need the path to the Google App Engine SDK.")
+    sdk = os.path.abspath(args[0])
+    here = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, here)
+    template = open(os.path.join(here, "jcamp-test.jdx")).read()
+    report = {"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+              "python": sys.version.split()[0],
+              "queries": options.queries, "seed": options.seed, "sizes": {}}
+    for size in [int(size) for size in options.sizes.split(",")]:
+        generator = Generator(template, options.seed)
+        print "Benchmarking %d spectra..." % size
+        report["sizes"][str(size)] = results = run(sdk, size, options.queries, generator)
+        for name in sorted(results):
+            print "  %-14s %s" % (name, ", ".join(["%s=%.4g" % item for item
+                                                   in sorted(results[name].items())]))
+    setup_stubs(sdk)
+    from django.utils import simplejson
+    output = open(options.output, "w")
+    simplejson.dump(report, output, indent=2, sort_keys=True)
+    output.close()
+    print "Wrote %s" % options.output
+
+if __name__ == '__main__':
+    main()
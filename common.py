@@ -9,8 +9,11 @@ back end.
 
 import logging
 import pickle
+import time
+import threading
 
 from google.appengine.ext import db
+from google.appengine.api import memcache
 
 class DictProperty(db.Property):
     """Store a dictionary object in the Google Data Store."""
@@ -169,7 +172,7 @@ class Error(Exception):
 
 class InputError(Error):
     """Exception raised for errors in the input."""
-
+    
     def __init__(self, expr, msg):
         """
         Initialize the exception variables.
@@ -198,6 +201,26 @@ class ServerError(Error):
         self.log()
 
 
+class QuotaError(Error):
+    """Exception raised when a user has used up their quota for now."""
+    
+    def __init__(self, expr, msg, retry_after):
+        """
+        Initialize the exception variables.
+        
+        @param expr: Who has gone over quota
+        @type  expr: C{str}
+        @param msg: Explanation of which quota was used up
+        @type  msg: C{str}
+        @param retry_after: Number of seconds until the quota is refilled
+        @type  retry_after: C{int}
+        """
+        self.expr = expr
+        self.msg = msg
+        self.retry_after = retry_after
+        self.log()
+
+
 class AuthError(Error):
     """Exception raised for authorization errors."""
     
@@ -216,3 +239,155 @@ class AuthError(Error):
             self.expr = "Anonymous"
         self.msg = msg
         self.log()
+
+
+PROFILE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+"""Upper bounds in milliseconds of the buckets of the latency histograms. One
+more bucket holds everything slower."""
+
+class Profile(object):
+    """
+    Time the stages of a request.
+    
+    Code marks the end of each stage by calling L{lap}, which records the
+    time since the previous mark under the stage's name.
+    """
+    
+    def __init__(self):
+        """Start timing."""
+        self.start = self.last = time.time()
+        self.stages = []
+    
+    def lap(self, name):
+        """
+        Mark the end of a stage.
+        
+        @param name: Name of the stage
+        @type  name: C{str}
+        """
+        now = time.time()
+        self.stages.append((name, now - self.last))
+        self.last = now
+    
+    def total(self):
+        """
+        Get the time since timing started.
+        
+        @return: Number of seconds
+        @rtype: C{float}
+        """
+        return self.last - self.start
+
+
+class _NullProfile(object):
+    """Stand in for a L{Profile} when a request is not being timed."""
+    
+    def lap(self, name):
+        """
+        Do nothing.
+        
+        @param name: Name of the stage
+        @type  name: C{str}
+        """
+        pass
+
+
+_null_profile = _NullProfile()
+"""Stand-in profile shared by every request not being timed"""
+
+_local = threading.local()
+"""Profile of the request being handled by each thread, as its profile
+attribute"""
+
+def start_profile(enabled=True):
+    """
+    Start timing a request. A request that is not timed costs next to
+    nothing, as marking the end of a stage does nothing.
+    
+    @param enabled: Whether to time the request
+    @type  enabled: C{bool}
+    @return: The profile, or None if the request is not timed
+    @rtype: L{common.Profile}
+    """
+    if enabled:
+        _local.profile = Profile()
+        return _local.profile
+    _local.profile = _null_profile
+    return None
+
+def lap(name):
+    """
+    Mark the end of a stage of the request being timed, if it is.
+    
+    @param name: Name of the stage
+    @type  name: C{str}
+    """
+    getattr(_local, "profile", _null_profile).lap(name)
+
+def stop_profile():
+    """Stop timing the request."""
+    _local.profile = _null_profile
+
+def record_profile(action, profile):
+    """
+    Add the times of a request to the latency histograms of its action.
+    
+    Each stage, and the whole request as "total", has a count, a total
+    in milliseconds and a histogram, all kept as memcache counters. Every
+    counter is bumped in one batch, and any not there yet added in another.
+    
+    @param action: The request's action
+    @type  action: C{str}
+    @param profile: Times of the request
+    @type  profile: L{common.Profile}
+    """
+    deltas = {}
+    for stage, seconds in profile.stages + [("total", profile.total())]:
+        milliseconds = int(seconds * 1000)
+        bucket = len(PROFILE_BUCKETS)
+        for index, bound in enumerate(PROFILE_BUCKETS):
+            if milliseconds < bound:
+                bucket = index
+                break
+        prefix = "%s_%s_" % (action, stage)
+        for key, delta in (("count", 1), ("total", milliseconds), (str(bucket), 1)):
+            # A stage can be timed more than once in a request.
+            deltas[prefix + key] = deltas.get(prefix + key, 0) + delta
+    counters = memcache.offset_multi(deltas, key_prefix="stats_")
+    missing = dict([(key, delta) for key, delta in deltas.iteritems()
+                    if counters.get(key) is None])
+    if missing:
+        memcache.add_multi(missing, key_prefix="stats_")
+
+def profile_stats(actions, stages):
+    """
+    Get the latency histograms of actions.
+    
+    @param actions: Actions to get the histograms of
+    @type  actions: C{list} of C{str}
+    @param stages: Stages to get the histograms of, besides "total"
+    @type  stages: C{list} of C{str}
+    @return: For each action timed, for each of its stages timed, the count,
+    the total in milliseconds and the histogram as pairs of upper bounds
+    (None for the last bucket) and counts
+    @rtype: C{dict}
+    """
+    stages = list(stages) + ["total"]
+    keys = ["%s_%s_%s" % (action, stage, key)
+            for action in actions for stage in stages
+            for key in ["count", "total"] + [str(bucket) for bucket
+                                             in range(len(PROFILE_BUCKETS) + 1)]]
+    counters = memcache.get_multi(keys, key_prefix="stats_")
+    stats = {}
+    for action in actions:
+        for stage in stages:
+            prefix = "%s_%s_" % (action, stage)
+            if prefix + "count" not in counters:
+                continue
+            bounds = list(PROFILE_BUCKETS) + [None]
+            stats.setdefault(action, {})[stage] = {
+                "count": counters[prefix + "count"],
+                "total": counters.get(prefix + "total", 0),
+                "histogram": [(bound, counters.get(prefix + str(bucket), 0))
+                              for bucket, bound in enumerate(bounds)]}
+    return stats
@@ -2,7 +2,8 @@
 RedHen API v0.2
 
 Any request that requires a file upload must be a POST request. Only the
-update, projects, data, and browse actions are allowed in a GET request.
+update, projects, data, browse and jobstatus actions are allowed in a GET
+request.
 The GET/POST variables below may be passed. If uploading files, make sure
 to set enctype to multipart/form-data, or they will not be processed properly.
 
@@ -15,6 +16,23 @@ General Options:
      - "browse" - Browse either the public database or a specific project.
      - "projects" - List all projects the user can access.
      - "bulkadd" - Add a mass amount of spectra to the database as once.
+     - "jobstatus" - Get the progress of an update or bulkadd (only whoever
+       started it and admins).
+     - "resume" - Restart a failed update or bulkadd, or queue the work left
+       for a running one again, then get its progress (admin-only).
+     - "stats" - Get latency histograms of a sample of requests, for every
+       action and every stage of handling it (admin-only). For each, this
+       gives the number of requests timed, their total time in milliseconds
+       and how many took up to each of a series of times in milliseconds.
+   Updates and bulkadds run in the background. Their response is the key of
+   the job doing the work, to be given as job when asking for its status or
+   resuming it.
+   The status tells the job's action, whether it is "running", "done" or
+   "failed", how many of its chunks are finished out of how many there are
+   so far (and whether that is all of them), how many of them an update has
+   merged into the new Matchers, how many spectra it has processed, and why
+   it failed, if it did. Searches keep using the old Matchers until an
+   update is done. A resumed job keeps the chunks it finished.
  - spectrum (required for some actions): The spectrum (either file or database
    key) to do the action on. Depending on the action, multiple spectra can be
    uploaded here.
@@ -24,8 +42,20 @@ General Options:
       two spectra against each other.
     - When action is "browse": Can be either "public" for browsing the public
       library or a database key referring to the project being browsed.
- - output (optional, defaults to "pickle"): Can be "xml", "json", "python", or
-   "pickle" depending on what output format you want.
+ - timing (optional): Time this request, and give the time taken by every
+   stage of handling it in a Server-Timing header.
+ - output (optional, defaults to "pickle"): Can be "xml", "json", "python",
+   "pickle" or "binary" depending on what output format you want. The binary
+   format is a tagged encoding, little-endian throughout: "N" is None, "T"
+   and "F" are booleans, "i" is followed by a 64-bit integer, "d" by a 64-bit
+   float, "s" by a 32-bit length and that many bytes of UTF-8, "l" by a
+   32-bit count and that many items, "m" by a 32-bit count and that many
+   keys and values, and "f" by a 32-bit count and that many 32-bit floats,
+   which is how lists of floats such as graph data are packed.
+ - precision (optional, JSON output only): Number of significant digits to
+   give floats with. Defaults to full precision.
+Responses of more than a kilobyte are gzipped if the Accept-Encoding header
+allows it.
 
 Browsing Options:
  - limit: How many spectra to get when browsing (maximum is 50).
@@ -35,28 +65,104 @@ Browsing Options:
    what we are giving suggestions for.
 
 Comparing Options:
- - algorithm (defaults to "bove"): Which linear algorithm to compare spectra with
+ - algorithm (defaults to "bove"): Which linear algorithm to compare spectra
+   with ("bove", "leastsquares", "euclidean", "cosine", "pearson" or "dtw",
+   which tolerates spectra shifted by instrument drift)
+ - preprocessing: Compare the spectra after removing their baseline
+   ("baseline"), taking their first derivative ("derivative") or scaling them
+   to unit length ("normalized"). Defaults to comparing the raw data.
+ - mode (when comparing spectra to each other, defaults to "first"):
+    - "first" - Compare every spectrum to the first one.
+    - "matrix" - Return the error between every pair of spectra.
+    - "nearest" - Return the index of and error to each spectrum's nearest
+      neighbour.
+    - "cluster" - Return an average-linkage clustering of the spectra as a
+      list of merges, each giving the two clusters merged, the error between
+      them and the size of the new cluster. Spectra are clusters 0 to n - 1,
+      and the cluster made by the i-th merge is n + i.
+    - "mixture" (when target is "public") - Break the spectrum down into a
+      mixture of spectra from the database. The response is a list of the
+      key, chemical name, weight and graph data of each spectrum in the
+      mixture, followed by the norm of the part left unexplained.
+   For "matrix", "nearest" and "cluster", the response is a list of the
+   spectra's keys (None if uploaded) and chemical names, followed by the
+   result. At most 10 spectra can be compared this way with "dtw".
+ - type: What type of spectra (infrared or raman) to search, or "all" to
+   search every type. Defaults to the type given in the uploaded file.
+ - fields (defaults to "key,chemical_name,error"): Comma-separated fields to
+   give for each spectrum in the results, out of "key", "chemical_name",
+   "chemical_type", "spectrum_type", "error" and "graph_data".
+ - k (when target is "public"): Only give the best k results, where k is at
+   least 1. If there are more, the X-Cursor response header holds a cursor
+   for the next page.
+ - cursor (when target is "public"): Give the next page of a search instead
+   of searching again. The cursor expires after a few minutes.
+ - When target is "public", several spectra can be uploaded at once. They
+   are searched together, and the response has one result list per spectrum,
+   in the order they were uploaded.
 
 @organization: The Cooper Union for the Advancement of the Science and the Arts
 @license: http://opensource.org/licenses/lgpl-3.0.html GNU Lesser General Public License v3.0
 @copyright: Copyright (c) 2010, Cooper Union (Some Right Reserved)
 """
 from google.appengine.api import users, memcache, quota
-from google.appengine.ext import webapp, db
+from google.appengine.ext import webapp
 from google.appengine.ext.webapp.util import run_wsgi_app
 from google.appengine.runtime.apiproxy_errors import CapabilityDisabledError
 
+import time
+import math
+import random
+import struct
+import gzip
+import hashlib
+import StringIO
+import cPickle
+from xml.sax.saxutils import escape
+from django.utils import simplejson
+
 import appengine_utilities.sessions
 import common
 import backend
+import jobs
 
 class ApiHandler(webapp.RequestHandler):
     """Handle any API requests and return a JSON response."""
     
     CPU_LIMIT = 50000 # We need to determine a reasonable number to put here.
+    """Megacycles of CPU a user or address can use in a burst before it has
+    to wait for its quota to refill."""
+    
+    CPU_RATE = 500
+    """Megacycles per second quotas refill at."""
+    
+    QUOTA_TICK = 10
+    """Number of seconds between quota refills."""
+    
+    PROFILE_SAMPLE_RATE = 0.01
+    """Fraction of requests timed for the latency histograms."""
+    
+    ACTIONS = ("compare", "add", "delete", "update", "browse", "projects",
+               "bulkadd", "jobstatus", "resume", "stats")
+    """Actions the latency histograms are kept for."""
+    
+    STAGES = ("setup", "parse", "matcher", "candidates", "fetch", "score",
+              "handle", "serialize")
+    """Stages of handling a request that are timed, in order."""
+    
+    FIELDS = ("key", "chemical_name", "chemical_type", "spectrum_type", "error",
+              "graph_data")
+    """Fields of a spectrum that can be asked for in search results."""
+    
+    COMPRESS_THRESHOLD = 1024
+    """Size in bytes above which responses are compressed."""
+    
+    COMPRESSED_TIME = 3600
+    """Number of seconds compressed GET responses are kept for reuse."""
     
     def get(self):
-        if self.request.get("action") in ("update", "projects", "data", "browse"):
+        if self.request.get("action") in ("update", "projects", "data", "browse",
+                                          "jobstatus", "stats"):
             self.post()
         else:
             self.help()
@@ -71,47 +177,90 @@ class ApiHandler(webapp.RequestHandler):
         @raise common.InputError: If no search targets are given in the target
         POST variable or if an invalid action is given.
         """
-        cpu_start = quota.get_request_cpu_usage()
-        
+        # Time a sample of requests, and any asking for it.
+        self._sampled = random.random() < self.PROFILE_SAMPLE_RATE
+        self._profile = common.start_profile(self._sampled or
+                                             bool(self.request.get("timing")))
         action = self.request.get("action")
         target = self.request.get("target", "public")
         spectra = self.request.get_all("spectrum") #Some of these will be in session data
-        limit = self.request.get("limit", 10)
-        offset = self.request.get("offset", 0)
+        limit = self._integer("limit", 10, 1, 50)
+        offset = self._integer("offset", 0)
         algorithm = self.request.get("algorithm", "bove")
         guess = self.request.get("guess")
         spectrum_type = self.request.get("type")
+        mode = self.request.get("mode", "first")
+        stage = self.request.get("preprocessing") or None
+        k = self._integer("k", None, 1)
+        precision = self._integer("precision", None, 1)
+        cursor = self.request.get("cursor") or None
+        fields = self.request.get("fields", "key,chemical_name,error").split(",")
         raw = self.request.get("raw", False)
-        session = appengine_utilities.sessions.Session()
         user = users.get_current_user()
         response = []
         
-        # First check if the user has gone over quota.
-        if session.get("cpu_usage") > self.CPU_LIMIT:
-            raise common.ServerError("User has gone over quota.")
+        # First check if the user or address has gone over quota.
+        self._check_quota(user)
+        
+        # Browsing and listing projects only give something new when the
+        # project or Matcher behind them has changed, so check that first.
+        # Private projects are only checked once the user is allowed in.
+        cacheable = self.request.method == "GET" and action in ("browse", "projects")
+        if cacheable and (action == "projects" or target == "public"):
+            if self._not_modified(action, target, guess, spectrum_type, user):
+                return
+        
+        for field in fields:
+            if field not in self.FIELDS:
+                raise common.InputError(field, "Invalid field.")
         
-        spectra = [open('jcamp-test.jdx').read()] # Just for testing
-
         # If not operating on the main project, try getting the private one.
         # But abort if target is not supposed to be a project.
         if target and target != "public":
             target = backend.Project.get(target)
             if target is None:
                 raise common.InputError(targets, "Invalid project ID.")
+        common.lap("setup")
         # Start doing the request
-        if action == "compare" and target == "public":
-            # Search the database for something.
+        if action == "compare" and target == "public" and mode == "mixture":
+            # Break a mixture down into spectra from the database.
             for spectrum in spectra:
-                # User wants to commit a new search with a file upload.
-                result = backend.search(spectrum)
-                # Extract relevant information and add to the response.
-                response = [(str(i.key()), i.chemical_name, i.error, i.graph_data) for i in result]
+                result, residual = backend.mixture(spectrum, spectrum_type or None)
+                response.append([[(str(i.key()), i.chemical_name, i.weight, i.graph_data)
+                                  for i in result], residual])
+            if len(response) == 1:
+                response = response[0]
+        elif action == "compare" and target == "public":
+            # Search the database for every uploaded spectrum at once.
+            if k is None and cursor is None:
+                results = backend.search_many(spectra, spectrum_type or None, algorithm,
+                                              None, stage)
+            else:
+                # Only give one page, and where to get the next one from.
+                results, cursor = backend.search_page(spectra, spectrum_type or None,
+                                                      algorithm, k or 10, stage, cursor)
+                if cursor is not None:
+                    self.response.headers["X-Cursor"] = cursor
+            # Extract relevant information and add to the response.
+            for result in results:
+                response.append([self._project(i, error, fields) for i, error in result])
+            if len(response) == 1:
+                response = response[0]
         elif action == "compare":
             # Compare multiple spectra uploaded in this session.
-            response.append(backend.compare(spectra, algorithm))
+            result = backend.compare(spectra, algorithm, mode, stage)
+            if mode == "first":
+                response = [self._project(i, i.error, fields) for i in result]
+            else:
+                # Name the spectra, then give the pairwise result.
+                spectra, result = result
+                response = [[(self._key(i), i.chemical_name) for i in spectra], result]
         elif action == "browse":
             # Get a list of spectra from the database for browsing
             backend.auth(user, target, "view")
+            if cacheable and target != "public":
+                if self._not_modified(action, str(target.key()), guess, spectrum_type, user):
+                    return
             # Return the database key, name, and chemical type.
             results = [(str(spectrum.key()), spectrum.chemical_name, spectrum.chemical_type)
                        for spectrum in backend.browse(target, limit, offset, guess, spectrum_type)]
@@ -123,10 +272,11 @@ class ApiHandler(webapp.RequestHandler):
                 backend.add(spectrum_data, target, False)
         elif action == "bulkadd":
             # Add a new spectrum to the database. Supports multiple spectra.
+            # Only bulkadds need the session, so only they pay for loading it.
+            session = appengine_utilities.sessions.Session()
             if session.key().name() != "uploader":
                 raise common.AuthError(user, "Only the uploader can bulkadd.")
-            for spectrum_data in spectra:
-                backend.add(spectrum_data, target, True)
+            response.append(str(jobs.start_bulkadd(spectra, target, True, user).key()))
         elif action == "delete":
             # Delete a spectrum from the database.
             backend.auth(user, target, "spectrum")
@@ -134,44 +284,82 @@ class ApiHandler(webapp.RequestHandler):
                 backend.delete(spectrum_data, target)
         elif action == "update":
             backend.auth(user, "public", "spectrum")
-            backend.update()
+            response.append(str(jobs.start_update(user).key()))
+        elif action == "stats":
+            if not users.is_current_user_admin():
+                raise common.AuthError(user, "Need to be an admin.")
+            response = common.profile_stats(self.ACTIONS, self.STAGES)
+        elif action == "jobstatus":
+            response = jobs.status(self.request.get("job"), user)
+        elif action == "resume":
+            if not users.is_current_user_admin():
+                raise common.AuthError(user, "Need to be an admin.")
+            jobs.resume(self.request.get("job"))
+            response = jobs.status(self.request.get("job"), user)
         elif action == "projects":
             query = "WHERE :1 IN owners OR :1 IN collaborators OR :1 in viewers"
-            response.extend([(proj.key(), proj.name) for proj in Project.gql(query, user)])
+            response.extend([(str(proj.key()), proj.name)
+                             for proj in backend.Project.gql(query, user)])
         else:
             # Invalid action. Raise an error.
             raise common.InputError(action, "Invalid API action.")
         # Pass it on to self.output for processing.
-        self.output(response)
+        common.lap("handle")
+        self.output(response, precision)
+        common.lap("serialize")
+        self._finish_profile(action)
         
-        # Add on the request's CPU usage to the session quota.
-        #cpu_end = quota.get_request_cpu_usage()
-        #session['cpu_usage'] = session.get('cpu_usage') + cpu_end - cpu_start
+        # Take the request's CPU usage out of the quota.
+        self._charge_quota()
     
-    def output(self, response):
+    def output(self, response, precision=None):
         """
         Take a response from the script and process it for returning to the
         user. Output formats include a serialized pickle object, JSON, XML,
-        or Python (simply running str() on the response.
+        a compact binary format, or Python (simply running str() on the
+        response.
+        
+        Except for Python, the response is encoded and written out a piece at
+        a time rather than built up as one string first.
         
         @param response: Server response to encode
         @type  response: Mixed
+        @param precision: Number of significant digits to give floats with in
+        JSON, or None for full precision
+        @type  precision: C{int}
         @raise common.InputError: If an invalid output format is given.
         """
         format = self.request.get("output", "json")
+        self.response.headers["Vary"] = "Accept-Encoding"
+        if self._accepts_gzip():
+            cache_time = 0
+            if self.request.method == "GET":
+                # GET responses are often asked for again, so their compressed
+                # bodies are worth keeping.
+                cache_time = self.COMPRESSED_TIME
+            out = _CompressedWriter(self.response, self.COMPRESS_THRESHOLD, cache_time)
+        else:
+            out = self.response.out
         if format == "pickle":
-            import pickle
-            response = pickle.dumps(response)
+            cPickle.dump(response, out)
         elif format == "json":
-            from django.utils import simplejson
-            response = simplejson.dumps(response)
+            for chunk in self._convert_to_json(response, precision):
+                out.write(chunk)
         elif format == "xml":
-            response = self._convert_to_xml(response)
+            out.write("<?xml version=\"1.0\"?>\n<response>")
+            for chunk in self._convert_to_xml_internal(response):
+                out.write(chunk)
+            out.write("</response>")
+        elif format == "binary":
+            self.response.headers["Content-Type"] = "application/octet-stream"
+            for chunk in self._convert_to_binary(response):
+                out.write(chunk)
         elif format == "python":
-            response = str(response)
+            out.write(str(response))
         else:
             raise common.InputError(format, "Invalid output format.")
-        self.response.out.write(response)
+        if out is not self.response.out:
+            out.close()
     
     def handle_exception(self, exception, debug_mode):
         """
@@ -188,6 +376,10 @@ class ApiHandler(webapp.RequestHandler):
         """
         # TODO: Convert errors into a JSON response so the front end can handle
         #       them easily.
+        common.stop_profile()
+        # The tag was for the response that was not given.
+        if "ETag" in self.response.headers:
+            del self.response.headers["ETag"]
         if isinstance(exception, common.ServerError):
             # Server error: notify user.
             self.error(500)
@@ -202,69 +394,504 @@ class ApiHandler(webapp.RequestHandler):
             self.error(401)
             url = users.create_login_url("/")
             self.output(["AuthError", exception.expr, exception.msg, url])
+        elif isinstance(exception, common.QuotaError):
+            # Quota error: the user has to wait before trying again.
+            self.error(503)
+            self.response.headers["Retry-After"] = str(exception.retry_after)
+            self.output(["QuotaError", exception.expr, exception.msg,
+                         exception.retry_after])
         elif isinstance(exception, CapabilityDisabledError):
             # Maintenance error: AppEngine is down for maintenance.
             self.error(503)
             self.output(["AppEngine is down for maintenance."])
         else:
             # Send all else to Google.
+            self._charge_quota()
             super(ApiHandler, self).handle_exception(exception, True)
-
+            return
+        self._charge_quota()
+    
     def help(self):
         """Print help information for the API."""
         self.response.out.write("<pre>%s</pre>" % __doc__)
     
-    def _convert_to_xml(self, item):
+    def _integer(self, name, default, minimum=0, maximum=None):
+        """
+        Get a whole number from the request.
+        
+        @param name: Name of the variable
+        @type  name: C{str}
+        @param default: Value to give if the variable is not set
+        @type  default: C{int}
+        @param minimum: Smallest value allowed
+        @type  minimum: C{int}
+        @param maximum: Largest value allowed, or None if there is no limit
+        @type  maximum: C{int}
+        @return: The number
+        @rtype: C{int}
+        @raise common.InputError: If the value is not a whole number or is out
+        of range
+        """
+        value = self.request.get(name)
+        if not value:
+            return default
+        try:
+            number = int(value)
+        except ValueError:
+            raise common.InputError(value, "Invalid %s." % name)
+        if number < minimum or (maximum is not None and number > maximum):
+            raise common.InputError(value, "Value of %s is out of range." % name)
+        return number
+    
+    def _key(self, spectrum):
+        """
+        Get the database key of a spectrum for output.
+        
+        @param spectrum: Spectrum to get the key of
+        @type  spectrum: L{backend.Spectrum}
+        @return: The key, or None if the spectrum was uploaded and not stored
+        @rtype: C{str}
+        """
+        if spectrum.is_saved():
+            return str(spectrum.key())
+        return None
+    
+    def _finish_profile(self, action):
+        """
+        Stop timing the request. Add its times to the latency histograms if
+        it was picked for the sample, and give them in a Server-Timing header
+        if they were asked for.
+        
+        @param action: The request's action
+        @type  action: C{str}
+        """
+        common.stop_profile()
+        if self._profile is None:
+            return
+        if self._sampled and action in self.ACTIONS:
+            common.record_profile(action, self._profile)
+        if self.request.get("timing"):
+            self.response.headers["Server-Timing"] = ", ".join(
+                ["%s;dur=%.1f" % (stage, seconds * 1000)
+                 for stage, seconds in self._profile.stages])
+    
+    def _check_quota(self, user):
+        """
+        Refill the quotas of the user and the address the request came from,
+        then check that neither has run out.
+        
+        Each quota is a token bucket kept in memcache as the CPU used and not
+        yet refilled, so requests only ever change it atomically. The first
+        request in every L{QUOTA_TICK} refills the bucket for the time since
+        it was last refilled.
+        
+        @param user: User making the request, or None if not logged in
+        @type  user: L{google.appengine.api.users.User}
+        @raise common.QuotaError: If either quota has run out
+        """
+        self._quota_start = quota.get_request_cpu_usage()
+        self._buckets = ["quota_address_" + self.request.remote_addr]
+        if user is not None:
+            self._buckets.append("quota_user_" + user.email())
+        now = time.time()
+        tick = int(now) // self.QUOTA_TICK
+        for bucket in self._buckets:
+            if memcache.add("%s_%d" % (bucket, tick), True, self.QUOTA_TICK * 2):
+                # This is the first request this tick, so refill the bucket.
+                last = memcache.get(bucket + "_tick")
+                memcache.set(bucket + "_tick", tick)
+                if last is None:
+                    refill = self.CPU_LIMIT
+                else:
+                    refill = min((tick - last) * self.QUOTA_TICK * self.CPU_RATE,
+                                 self.CPU_LIMIT)
+                if refill > 0:
+                    memcache.decr(bucket, refill)
+        for bucket, used in memcache.get_multi(self._buckets).iteritems():
+            if used > self.CPU_LIMIT:
+                # Wait for as many refills as it takes to get under the limit.
+                ticks = math.ceil((used - self.CPU_LIMIT) /
+                                  float(self.QUOTA_TICK * self.CPU_RATE))
+                retry_after = int((tick + ticks) * self.QUOTA_TICK - now) + 1
+                raise common.QuotaError(bucket[6:], "Over CPU quota.", retry_after)
+    
+    def _charge_quota(self):
+        """Take the CPU the request used so far out of its quotas."""
+        if not hasattr(self, "_buckets"):
+            return
+        used = quota.get_request_cpu_usage() - self._quota_start
+        for bucket in self._buckets:
+            if memcache.incr(bucket, used) is None:
+                # Bucket was evicted, so start it again.
+                memcache.add(bucket, used)
+        del self._buckets
+    
+    def _not_modified(self, action, target, guess, spectrum_type, user):
+        """
+        Tag a browse or projects response, and answer it with a 304 if the
+        client already has it.
+        
+        @param action: "browse" or "projects"
+        @type  action: C{str}
+        @param target: "public" or the key of the project being browsed
+        @type  target: C{str}
+        @param guess: What the user has typed, when getting search suggestions
+        @type  guess: C{str}
+        @param spectrum_type: Type of spectra to suggest, or "" for all of them
+        @type  spectrum_type: C{str}
+        @param user: User making the request
+        @type  user: L{google.appengine.api.users.User}
+        @return: Whether the request was answered
+        @rtype: C{bool}
+        @raise common.InputError: If an invalid spectrum type is given
+        """
+        if action == "projects" or target != "public":
+            # Do not let shared caches keep private data.
+            self.response.headers["Cache-Control"] = "private, max-age=0, must-revalidate"
+        else:
+            self.response.headers["Cache-Control"] = "public, max-age=0, must-revalidate"
+        etag = self._etag(action, target, guess, spectrum_type, user)
+        self.response.headers["ETag"] = etag
+        matches = self.request.headers.get("If-None-Match", "")
+        if etag in [match.strip() for match in matches.split(",")] or matches == "*":
+            self.response.set_status(304)
+            common.lap("handle")
+            self._finish_profile(action)
+            self._charge_quota()
+            return True
+        return False
+    
+    def _etag(self, action, target, guess, spectrum_type, user):
+        """
+        Get the entity tag of a browse or projects response.
+        
+        The tag is a digest of the request, the user and the generations of
+        everything the response is made from, so it changes whenever the
+        response could.
+        
+        @param action: "browse" or "projects"
+        @type  action: C{str}
+        @param target: "public" or the key of the project being browsed
+        @type  target: C{str}
+        @param guess: What the user has typed, when getting search suggestions
+        @type  guess: C{str}
+        @param spectrum_type: Type of spectra to suggest, or "" for all of them
+        @type  spectrum_type: C{str}
+        @param user: User making the request
+        @type  user: L{google.appengine.api.users.User}
+        @return: The quoted entity tag
+        @rtype: C{str}
+        @raise common.InputError: If an invalid spectrum type is given
+        """
+        generations = backend.generations(action, target, guess, spectrum_type)
+        digest = hashlib.md5("%s|%s|%s" % (self.request.query_string, user and user.email(),
+                                           generations))
+        return '"%s"' % digest.hexdigest()
+    
+    def _accepts_gzip(self):
         """
-        Convert a given item to XML.
+        Check whether the client accepts gzipped responses.
+        
+        @return: Whether the Accept-Encoding header allows gzip
+        @rtype: C{bool}
+        """
+        for encoding in self.request.headers.get("Accept-Encoding", "").split(","):
+            encoding = encoding.split(";")
+            name = encoding[0].strip().lower()
+            if name not in ("gzip", "x-gzip", "*"):
+                continue
+            for parameter in encoding[1:]:
+                parameter = parameter.strip()
+                if parameter.startswith("q="):
+                    try:
+                        return float(parameter[2:]) > 0
+                    except ValueError:
+                        return False
+            return True
+        return False
+    
+    def _project(self, spectrum, error, fields):
+        """
+        Get the fields asked for of a spectrum in the results.
+        
+        @param spectrum: Spectrum in the results
+        @type  spectrum: L{backend.Spectrum}
+        @param error: The spectrum's error
+        @type  error: C{float}
+        @param fields: Names of the fields to get, in order
+        @type  fields: C{list} of C{str}
+        @return: Values of the fields
+        @rtype: C{tuple}
+        """
+        values = []
+        for field in fields:
+            if field == "key":
+                values.append(self._key(spectrum))
+            elif field == "error":
+                values.append(error)
+            else:
+                values.append(getattr(spectrum, field))
+        return tuple(values)
+    
+    def _convert_to_json(self, item, precision=None):
+        """
+        Convert a given item to JSON a piece at a time.
+        
+        Lists holding no lists or dictionaries, like graph data, are encoded
+        in one piece. Anything JSON has no type for is encoded as the string
+        it converts to, so database keys come out as their string form.
         
         @param item: Item to convert
         @type  item: Mixed
-        @return: Response in XML format
+        @param precision: Number of significant digits to give floats with,
+        or None for full precision
+        @type  precision: C{int}
+        @return: Pieces of the response in JSON format
+        @rtype: C{generator} of C{str}
+        """
+        if isinstance(item, (list, tuple)):
+            for value in item:
+                if isinstance(value, (list, tuple, dict)):
+                    break
+            else:
+                # Nothing nested, so there is nothing to gain by recursing.
+                # Finite floats are by far the most common, so format those
+                # here directly.
+                if precision is None:
+                    convert = repr
+                else:
+                    convert = lambda value: "%.*g" % (precision, value)
+                values = []
+                for value in item:
+                    if value.__class__ is float and value - value == 0:
+                        values.append(convert(value))
+                    else:
+                        values.append(self._json_value(value, precision))
+                yield "[" + ", ".join(values) + "]"
+                return
+            yield "["
+            for index, value in enumerate(item):
+                if index:
+                    yield ", "
+                for chunk in self._convert_to_json(value, precision):
+                    yield chunk
+            yield "]"
+        elif isinstance(item, dict):
+            yield "{"
+            for index, (key, value) in enumerate(item.iteritems()):
+                if index:
+                    yield ", "
+                yield self._json_value(unicode(key), precision) + ": "
+                for chunk in self._convert_to_json(value, precision):
+                    yield chunk
+            yield "}"
+        else:
+            yield self._json_value(item, precision)
+    
+    def _json_value(self, item, precision=None):
+        """
+        Convert a single value, not a list or dictionary, to JSON.
+        
+        @param item: Value to convert
+        @type  item: Mixed
+        @param precision: Number of significant digits to give floats with,
+        or None for full precision
+        @type  precision: C{int}
+        @return: The value in JSON format
         @rtype: C{str}
         """
-        xml = "<?xml version=\"1.0\"?>\n<response>"
-        xml += self._convert_to_xml_internal(item)
-        return xml + "</response>"
+        if isinstance(item, float):
+            if item != item:
+                return "NaN"
+            elif item in (float("inf"), float("-inf")):
+                return item > 0 and "Infinity" or "-Infinity"
+            elif precision is None:
+                return repr(item)
+            return "%.*g" % (precision, item)
+        elif item is None:
+            return "null"
+        elif isinstance(item, bool):
+            return item and "true" or "false"
+        elif isinstance(item, (int, long)):
+            return str(item)
+        elif isinstance(item, basestring):
+            return simplejson.dumps(item)
+        return simplejson.dumps(str(item))
     
     def _convert_to_xml_internal(self, item):
         """
         Internal function for processing output into XML format.
         
-        While the main function sets up the XML header, this actually converts
-        to XML. If item is a string, int, etc., just return it. If it is a
-        list, enclose each value in an <item></item> tag and run this function
-        recursively on whatever the value is. Do the same for dictionaries
-        except use the key as the tag name instead of <item>.
+        While L{output} writes the XML header, this actually converts to XML,
+        a piece at a time. If item is a string, int, etc., escape it. If it
+        is a list, enclose each value in an <item></item> tag and run this
+        function recursively on whatever the value is. Do the same for
+        dictionaries except use the key as the tag name instead of <item>.
         
         @param item: Item to convert
         @type  item: Mixed
-        @return: Response in XML format
-        @rtype: C{str}
+        @return: Pieces of the response in XML format
+        @rtype: C{generator} of C{str}
         """
-        if   (isinstance(item, str) or
-              isinstance(item, unicode) or
-              isinstance(item, int) or
-              isinstance(item, float)):
-            # Item is a string, unicode, integer, or float. Just return it.
-            return str(item)
-        elif (isinstance(item, list) or
-              isinstance(item, tuple)):
+        if (isinstance(item, list) or
+            isinstance(item, tuple)):
             # Item is a list or tuple. Enclose each item in <item></item> and
             # run this function recursively on each item.
-            xml = ""
             for value in item:
-                xml += "<item>" + self._convert_to_xml_internal(value) + "</item>"
-            return xml
+                if not isinstance(value, float):
+                    break
+            else:
+                # A list of floats, like graph data, needs no escaping.
+                yield "".join(["<item>%s</item>" % value for value in item])
+                return
+            for value in item:
+                yield "<item>"
+                for chunk in self._convert_to_xml_internal(value):
+                    yield chunk
+                yield "</item>"
         elif isinstance(item, dict):
             # Item is a dictionary. Do the same as is done above for a list,
             # except use the keys as tag names.
             for key, value in item.iteritems():
-                xml += "<" + key + ">" + self._convert_to_xml_internal(item) + "</" + key + ">"
-            return xml
+                yield "<" + key + ">"
+                for chunk in self._convert_to_xml_internal(value):
+                    yield chunk
+                yield "</" + key + ">"
+        elif isinstance(item, unicode):
+            yield escape(item.encode("utf-8"))
+        elif item is not None:
+            # Item is a string, integer, float, key, etc. Just escape it.
+            yield escape(str(item))
+    
+    def _convert_to_binary(self, item):
+        """
+        Convert a given item to the compact binary format a piece at a time.
+        
+        See the documentation for this module for the format.
+        
+        @param item: Item to convert
+        @type  item: Mixed
+        @return: Pieces of the response in binary format
+        @rtype: C{generator} of C{str}
+        """
+        if isinstance(item, (list, tuple)):
+            for value in item:
+                if not isinstance(value, float):
+                    break
+            else:
+                if item:
+                    # Pack a list of floats as one array.
+                    yield "f" + struct.pack("<I%df" % len(item), len(item), *item)
+                    return
+            yield "l" + struct.pack("<I", len(item))
+            for value in item:
+                for chunk in self._convert_to_binary(value):
+                    yield chunk
+        elif isinstance(item, dict):
+            yield "m" + struct.pack("<I", len(item))
+            for key, value in item.iteritems():
+                for chunk in self._convert_to_binary(key):
+                    yield chunk
+                for chunk in self._convert_to_binary(value):
+                    yield chunk
+        elif item is None:
+            yield "N"
+        elif isinstance(item, bool):
+            yield item and "T" or "F"
+        elif isinstance(item, (int, long)):
+            yield "i" + struct.pack("<q", item)
+        elif isinstance(item, float):
+            yield "d" + struct.pack("<d", item)
+        else:
+            if isinstance(item, unicode):
+                item = item.encode("utf-8")
+            else:
+                item = str(item)
+            yield "s" + struct.pack("<I", len(item)) + item
+
+class _CompressedWriter(object):
+    """
+    Write a response, gzipping it if it turns out to be big enough.
+    
+    Output is held back until it reaches the threshold. From then on it is
+    compressed as it is written, unless compressed bodies are being kept, in
+    which case the whole body is held back so it can be looked up in memcache
+    by its digest and only compressed if it is not there.
+    """
+    
+    def __init__(self, response, threshold, cache_time=0):
+        """
+        Start writing a response.
+        
+        @param response: Response to write the body of
+        @type  response: L{google.appengine.ext.webapp.Response}
+        @param threshold: Size in bytes above which the body is compressed
+        @type  threshold: C{int}
+        @param cache_time: Number of seconds to keep the compressed body for,
+        or 0 to not keep it
+        @type  cache_time: C{int}
+        """
+        self.response = response
+        self.threshold = threshold
+        self.cache_time = cache_time
+        self.buffer = []
+        self.size = 0
+        self.gzip = None
+    
+    def write(self, data):
+        """
+        Write part of the body.
+        
+        @param data: Part of the body to write
+        @type  data: C{str}
+        """
+        if self.gzip is not None:
+            self.gzip.write(data)
+            return
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size > self.threshold and not self.cache_time:
+            # Big enough: compress the rest as it comes.
+            self.response.headers["Content-Encoding"] = "gzip"
+            self.gzip = gzip.GzipFile(mode="wb", fileobj=self.response.out)
+            self.gzip.write("".join(self.buffer))
+            self.buffer = None
+    
+    def close(self):
+        """Finish writing the body."""
+        if self.gzip is not None:
+            self.gzip.close()
+            return
+        body = "".join(self.buffer)
+        if self.size <= self.threshold:
+            self.response.out.write(body)
+            return
+        key = "gzip_" + hashlib.md5(body).hexdigest()
+        compressed = memcache.get(key)
+        if compressed is None:
+            buffer = StringIO.StringIO()
+            compressor = gzip.GzipFile(mode="wb", fileobj=buffer)
+            compressor.write(body)
+            compressor.close()
+            compressed = buffer.getvalue()
+            memcache.set(key, compressed, self.cache_time)
+        self.response.headers["Content-Encoding"] = "gzip"
+        self.response.out.write(compressed)
+
+class WarmupHandler(webapp.RequestHandler):
+    """Get a new instance ready before it is sent any requests."""
+    
+    def get(self):
+        """
+        Load the Matchers and cached generations, so the first searches on
+        the instance do not have to. Every module the API needs is already
+        imported by loading this one.
+        """
+        backend.warmup()
 
 application = webapp.WSGIApplication([
-    ('/api', ApiHandler)
+    ('/api', ApiHandler),
+    ('/_ah/warmup', WarmupHandler)
 ], debug=True)
 
 def main():
@@ -0,0 +1,665 @@
+'''
+Run work too long for one request, rebuilding the Matchers and adding spectra
+in bulk, in the background as chunks on a task queue.
+
+A job is split into chunks small enough to finish well within a request
+deadline, and each chunk is a separate task, so the job goes as fast as there
+are workers to run its tasks. Progress is stored with the job as each chunk
+finishes. A chunk that fails is retried by the task queue, and finishing a
+chunk twice changes nothing, so a job carries on from where it stopped.
+
+Rebuilding the Matchers builds a new generation of them beside the ones in
+use, which keep answering searches throughout. The spectra are scanned in
+cursor-delimited chunks, one scan task at a time, and each chunk is handed
+off to its own task to find the features of its spectra. The chunks are
+then merged into the new Matchers a few at a time, and readers are switched
+over to them once every chunk is in. Adding spectra in bulk stores the
+uploaded spectra in chunks up front.
+
+Without the App Engine task queue (when testing), tasks are kept in a
+L{LocalQueue} in this process and run with L{LocalQueue.run}.
+
+@organization: The Cooper Union for the Advancement of the Science and the Arts
+@license: http://opensource.org/licenses/lgpl-3.0.html GNU Lesser General Public License v3.0
+@copyright: Copyright (c) 2010, Cooper Union (Some Right Reserved)
+'''
+
+import uuid
+import datetime
+
+from google.appengine.ext import db, webapp
+from google.appengine.api import users, memcache
+from google.appengine.ext.webapp.util import run_wsgi_app
+try:
+    from google.appengine.api.labs import taskqueue
+except ImportError:
+    taskqueue = None
+
+import common
+import backend
+
+TASK_URL = "/_jobs"
+'''URL the task queue runs job tasks at
+@type: C{str}'''
+
+CHUNK_SIZE = 20
+'''Number of uploaded spectra added per chunk of a bulk add
+@type: C{int}'''
+
+MERGE_CHUNKS = 20
+'''Number of finished chunks merged into the new Matchers per task when
+rebuilding them
+@type: C{int}'''
+
+LEASE_TIME = 600
+'''Number of seconds a task merging chunks holds its job for before
+another may take over, which is the longest a task can run
+@type: C{int}'''
+
+MAX_RETRIES = 10
+'''Number of times a failing task is retried before its job is marked
+failed
+@type: C{int}'''
+
+class Job(db.Model):
+    '''
+    Store the progress of a background job.
+    
+    Chunks are stored as children of their job, so a chunk can be marked
+    finished and counted towards its job in one transaction.
+    '''
+    
+    action = db.StringProperty(choices=["update", "bulkadd"])
+    '''What the job does
+    @type: C{str}'''
+    
+    state = db.StringProperty(choices=["running", "done", "failed"], default="running")
+    '''Whether the job is still running, has finished or has failed
+    @type: C{str}'''
+    
+    target = db.StringProperty(indexed=False)
+    '''"public" or the key of the project spectra are added to
+    @type: C{str}'''
+    
+    preprocessed = db.BooleanProperty(default=False, indexed=False)
+    '''Whether the spectra added are already integrated or not
+    @type: C{bool}'''
+    
+    started = db.BooleanProperty(default=False, indexed=False)
+    '''Whether building the new Matchers has started, when rebuilding them
+    @type: C{bool}'''
+    
+    scanned = db.BooleanProperty(default=False, indexed=False)
+    '''Whether every chunk of the job has been made
+    @type: C{bool}'''
+    
+    cursor = db.TextProperty()
+    '''Where scanning the spectra stopped, when rebuilding the Matchers
+    @type: C{str}'''
+    
+    chunks = db.IntegerProperty(default=0, indexed=False)
+    '''Number of chunks made so far
+    @type: C{int}'''
+    
+    finished = db.IntegerProperty(default=0, indexed=False)
+    '''Number of chunks finished so far
+    @type: C{int}'''
+    
+    merged = db.IntegerProperty(default=0, indexed=False)
+    '''Number of chunks merged into the new Matchers so far, when rebuilding
+    them
+    @type: C{int}'''
+    
+    lease = db.StringProperty(indexed=False)
+    '''Lease of the task merging chunks, if one is
+    @type: C{str}'''
+    
+    leased = db.DateTimeProperty(indexed=False)
+    '''When the task merging chunks took its lease
+    @type: C{datetime.datetime}'''
+    
+    spectra = db.IntegerProperty(default=0, indexed=False)
+    '''Number of spectra processed so far
+    @type: C{int}'''
+    
+    error = db.StringProperty(indexed=False)
+    '''Why the job failed, if it did
+    @type: C{str}'''
+    
+    user = db.UserProperty()
+    '''Who started the job, or None if they were not logged in
+    @type: L{google.appengine.api.users.User}'''
+    
+    created = db.DateTimeProperty(auto_now_add=True)
+    '''When the job was started
+    @type: C{datetime.datetime}'''
+    
+    updated = db.DateTimeProperty(auto_now=True)
+    '''When the job last made progress
+    @type: C{datetime.datetime}'''
+
+class JobChunk(db.Model):
+    '''
+    Store one chunk of a job's work. Chunks are keyed by their index, in
+    the entity group of their job.
+    '''
+    
+    keys = db.ListProperty(db.Key, indexed=False)
+    '''Spectra to merge into the Matchers, when rebuilding them
+    @type: C{list}'''
+    
+    spectra = db.ListProperty(db.Blob, indexed=False)
+    '''Uploaded spectra to add, when adding in bulk
+    @type: C{list}'''
+    
+    entries = common.GenericListProperty(indexed=False)
+    '''Key, spectrum type, heavyside index, peak x-values and chemical name
+    of each spectrum, once the chunk is finished, when rebuilding the Matchers
+    @type: C{list}'''
+    
+    done = db.BooleanProperty(default=False, indexed=False)
+    '''Whether the chunk has been finished
+    @type: C{bool}'''
+
+class TaskQueue(object):
+    '''Queue job tasks on the App Engine task queue.'''
+    
+    def add(self, params):
+        '''
+        Queue a task.
+        
+        @param params: Parameters of the task, given to L{run_task}
+        @type  params: C{dict}
+        '''
+        taskqueue.add(url=TASK_URL, params=params)
+
+class LocalQueue(object):
+    '''
+    Queue job tasks in this process, for when there is no task queue.
+    
+    Tasks are run in order, one at a time. A task that fails is put back at
+    the end of the queue with its retry count, as the task queue would
+    retry it.
+    '''
+    
+    def __init__(self):
+        '''Start with no tasks.'''
+        self.tasks = []
+    
+    def add(self, params):
+        '''
+        Queue a task.
+        
+        @param params: Parameters of the task, given to L{run_task}
+        @type  params: C{dict}
+        '''
+        self.tasks.append(params)
+    
+    def run(self):
+        '''
+        Run queued tasks until there are none left.
+        
+        @raise Exception: Whatever a failed task raised, after putting it
+        back on the queue
+        '''
+        while self.tasks:
+            params = self.tasks.pop(0)
+            try:
+                run_task(**params)
+            except:
+                params = dict(params, retries=params.get("retries", 0) + 1)
+                self.tasks.append(params)
+                raise
+
+if taskqueue is None:
+    queue = LocalQueue()
+else:
+    queue = TaskQueue()
+'''Queue job tasks are added to
+@type: L{TaskQueue} or L{LocalQueue}'''
+
+def start_update(user=None):
+    '''
+    Start rebuilding the Matchers in the background.
+    
+    @param user: Who is starting the job
+    @type  user: L{google.appengine.api.users.User}
+    @return: The job
+    @rtype: L{jobs.Job}
+    '''
+    job = Job(action="update", user=user)
+    job.put()
+    queue.add({"job": str(job.key()), "step": "start"})
+    return job
+
+def start_bulkadd(spectra_data, target="public", preprocessed=False, user=None):
+    '''
+    Start adding spectra in the background.
+    
+    @param spectra_data: Strings containing spectrum information
+    @type  spectra_data: C{list} of C{str}
+    @param target: Where to store the spectra
+    @type  target: "public" or L{backend.Project}
+    @param preprocessed: Whether spectra_data is already integrated or not
+    @type  preprocessed: C{bool}
+    @param user: Who is starting the job
+    @type  user: L{google.appengine.api.users.User}
+    @return: The job
+    @rtype: L{jobs.Job}
+    '''
+    if target != "public":
+        target = str(target.key())
+    job = Job(action="bulkadd", target=target, preprocessed=preprocessed, scanned=True,
+              user=user)
+    job.put()
+    spectra_data = [isinstance(spectrum_data, unicode) and spectrum_data.encode("utf-8")
+                    or spectrum_data for spectrum_data in spectra_data]
+    chunks = [JobChunk(parent=job, key_name="chunk%d" % index,
+                       spectra=[db.Blob(spectrum_data)
+                                for spectrum_data in spectra_data[start:start + CHUNK_SIZE]])
+              for index, start in enumerate(xrange(0, len(spectra_data), CHUNK_SIZE))]
+    db.put(chunks)
+    job.chunks = len(chunks)
+    job.put()
+    for chunk in chunks:
+        queue.add({"job": str(job.key()), "step": "chunk", "chunk": chunk.key().name()})
+    if not chunks:
+        _queue_finish(job)
+    return job
+
+def status(job_key, user):
+    '''
+    Get the progress of a job. Only whoever started it and admins can.
+    
+    @param job_key: Key of the job
+    @type  job_key: C{str}
+    @param user: Who is asking
+    @type  user: L{google.appengine.api.users.User}
+    @return: What the job does, its state, the number of chunks finished,
+    merged and made so far, the number of spectra processed and why it
+    failed, if it did
+    @rtype: C{dict}
+    @raise common.InputError: If an invalid job key is given
+    @raise common.AuthError: If the user did not start the job and is not
+    an admin
+    '''
+    job = _get_job(job_key)
+    if not users.is_current_user_admin() and (user is None or user != job.user):
+        raise common.AuthError(user, "Need to have started the job.")
+    return {"action": job.action, "state": job.state, "finished": job.finished,
+            "merged": job.merged, "chunks": job.chunks, "scanned": job.scanned,
+            "spectra": job.spectra, "error": job.error}
+
+def resume(job_key):
+    '''
+    Queue everything left to do for a job again, restarting it if it failed.
+    
+    The task queue retries failed tasks by itself, so this is only needed if
+    tasks were lost, for example if the queue was purged, or the job failed.
+    Queueing a step that was already done does nothing, and only one task at
+    a time merges a job's chunks, however many are queued. A failed update
+    keeps the chunks it finished, but starts its new Matchers again and
+    merges every chunk into them.
+    
+    @param job_key: Key of the job
+    @type  job_key: C{str}
+    @raise common.InputError: If an invalid job key is given
+    '''
+    job = _get_job(job_key)
+    def restart():
+        restarted = Job.get(job.key())
+        if restarted.state != "failed":
+            return restarted
+        restarted.state = "running"
+        restarted.error = None
+        if restarted.action == "update":
+            # Failing dropped the new Matchers.
+            restarted.started = False
+            restarted.merged = 0
+            restarted.lease = None
+        restarted.put()
+        return restarted
+    job = db.run_in_transaction(restart)
+    if job.state != "running":
+        return
+    if not job.started and job.action == "update":
+        queue.add({"job": str(job.key()), "step": "start"})
+        return
+    _queue_rest(job)
+
+def _queue_rest(job):
+    '''
+    Queue every chunk of a job left to do, and the scan or finish after.
+    
+    @param job: The job
+    @type  job: L{jobs.Job}
+    '''
+    job_key = str(job.key())
+    for chunk in JobChunk.all().ancestor(job):
+        if not chunk.done:
+            queue.add({"job": job_key, "step": "chunk", "chunk": chunk.key().name()})
+    if not job.scanned:
+        queue.add({"job": job_key, "step": "scan"})
+    elif job.finished == job.chunks:
+        _queue_finish(job)
+
+def run_task(job, step, chunk=None, lease=None, retries=0):
+    '''
+    Run one step of a job.
+    
+    A job rebuilding the Matchers starts a new generation of them, then scans
+    the spectra a chunk at a time. Every chunk is then run on its own, and
+    once all have finished, the job finishes by merging the chunks into the
+    new Matchers and switching to them. A job adding spectra in bulk
+    finishes by compacting the Matchers.
+    
+    A step that keeps failing is retried by the task queue until it has
+    been tried L{MAX_RETRIES} times, then its job is marked failed.
+    
+    @param job: Key of the job
+    @type  job: C{str}
+    @param step: "start", "scan", "chunk" or "finish"
+    @type  step: C{str}
+    @param chunk: Key name of the chunk, for the "chunk" step
+    @type  chunk: C{str}
+    @param lease: Lease to merge chunks under, for the "finish" step
+    @type  lease: C{str}
+    @param retries: Number of times the task has been retried already
+    @type  retries: C{int}
+    @raise common.InputError: If an invalid job key or step is given
+    '''
+    job = _get_job(job)
+    if job.state != "running":
+        return
+    if step not in ("start", "scan", "chunk", "finish"):
+        raise common.InputError(step, "Invalid job step.")
+    try:
+        if step == "start":
+            _start(job)
+        elif step == "scan":
+            _scan(job)
+        elif step == "chunk":
+            _run_chunk(job, chunk)
+        else:
+            _finish(job, lease)
+    except Exception, error:
+        if retries < MAX_RETRIES:
+            raise
+        # Retrying has not helped, so stop the job instead of retrying forever.
+        _fail(job, "%s failed: %s" % (step, error))
+
+def _get_job(job_key):
+    '''
+    Get a job by its key.
+    
+    @param job_key: Key of the job
+    @type  job_key: C{str}
+    @return: The job
+    @rtype: L{jobs.Job}
+    @raise common.InputError: If an invalid job key is given
+    '''
+    try:
+        job = Job.get(job_key)
+    except db.BadKeyError:
+        job = None
+    if job is None:
+        raise common.InputError(job_key, "Invalid job key.")
+    return job
+
+def _start(job):
+    '''
+    Start a new generation of Matchers, then start scanning the spectra.
+    
+    @param job: The job rebuilding the Matchers
+    @type  job: L{jobs.Job}
+    '''
+    if job.started:
+        return
+    backend.start_rebuild(_generation(job))
+    job.started = True
+    job.put()
+    # A restarted job may have chunks made, or be done scanning, already.
+    _queue_rest(job)
+
+def _scan(job):
+    '''
+    Make the next chunk of spectra to merge into the Matchers, then queue it
+    and the scan after it.
+    
+    @param job: The job rebuilding the Matchers
+    @type  job: L{jobs.Job}
+    '''
+    query = backend.Spectrum.all(keys_only=True)
+    if job.cursor:
+        query.with_cursor(job.cursor)
+    keys = query.fetch(backend.Matcher.BATCH_SIZE)
+    cursor = query.cursor()
+    # Make sure the spectra are in the public project. This is idempotent,
+    # so a scan that is run again after failing does no harm.
+    backend.extend_project(backend.Project.get_or_insert("public"), keys)
+    def make_chunk():
+        scanned = Job.get(job.key())
+        if scanned.cursor != job.cursor:
+            # This scan already ran.
+            return None, scanned
+        chunk = None
+        if keys:
+            chunk = JobChunk(parent=scanned, key_name="chunk%d" % scanned.chunks, keys=keys)
+            chunk.put()
+            scanned.chunks += 1
+        scanned.cursor = cursor
+        scanned.scanned = len(keys) < backend.Matcher.BATCH_SIZE
+        scanned.put()
+        return chunk, scanned
+    chunk, job = db.run_in_transaction(make_chunk)
+    if chunk is not None:
+        queue.add({"job": str(job.key()), "step": "chunk", "chunk": chunk.key().name()})
+    if not job.scanned:
+        queue.add({"job": str(job.key()), "step": "scan"})
+    elif job.finished == job.chunks:
+        _queue_finish(job)
+
+def _run_chunk(job, name):
+    '''
+    Do the work of one chunk and count it towards its job.
+    
+    @param job: The job
+    @type  job: L{jobs.Job}
+    @param name: Key name of the chunk
+    @type  name: C{str}
+    '''
+    chunk = JobChunk.get_by_key_name(name, parent=job)
+    if chunk is None or chunk.done:
+        return
+    entries = []
+    if job.action == "update":
+        # Find the features of the spectra now, so merging them into the new
+        # Matchers later does not have to load them again.
+        entries = [(spectrum.key(), spectrum.spectrum_type, spectrum.calculate_heavyside(),
+                    spectrum.calculate_peaks(), spectrum.chemical_name)
+                   for spectrum in backend.Spectrum.get(chunk.keys) if spectrum is not None]
+        count = len(entries)
+    else:
+        target = job.target
+        if target != "public":
+            target = backend.Project.get(target)
+            if target is None:
+                _fail(job, "Project was deleted.")
+                return
+        # Key the spectra by job and chunk, so running the chunk again only
+        # stores them again. The changes are only logged, and folded into the
+        # Matchers once when the job finishes.
+        key_names = ["job%s_%s_%d" % (job.key().id_or_name(), name, index)
+                     for index in xrange(len(chunk.spectra))]
+        try:
+            backend.add_many([str(spectrum_data) for spectrum_data in chunk.spectra],
+                             target, job.preprocessed, key_names, False)
+        except common.InputError, error:
+            # Running it again will not help.
+            _fail(job, error.msg)
+            return
+        count = len(chunk.spectra)
+    def finish_chunk():
+        finished = JobChunk.get_by_key_name(name, parent=job)
+        counted = Job.get(job.key())
+        if finished.done:
+            return counted, False
+        finished.done = True
+        finished.entries = entries
+        counted.finished += 1
+        counted.spectra += count
+        db.put([finished, counted])
+        return counted, counted.scanned and counted.finished == counted.chunks
+    job, last = db.run_in_transaction(finish_chunk)
+    if last:
+        _queue_finish(job)
+
+def _finish(job, lease=None):
+    '''
+    Finish the job, then mark it done.
+    
+    A job rebuilding the Matchers merges its chunks into the new Matchers a
+    few at a time, queueing this step again until all are merged, then
+    switches readers over to them. Otherwise, everything the job logged is
+    folded into the Matchers.
+    
+    @param job: The job
+    @type  job: L{jobs.Job}
+    @param lease: Lease to merge chunks under
+    @type  lease: C{str}
+    @raise common.ServerError: If another request is still compacting, so
+    the task is retried later
+    '''
+    if job.action == "update":
+        if not job.started:
+            # Restarted, and the start step queues this again once the new
+            # Matchers are started.
+            return
+        if job.merged < job.chunks:
+            _merge(job, lease)
+            return
+        for spectrum_type in backend.Spectrum.spectrum_type.choices:
+            backend.finish_rebuild(spectrum_type, _generation(job))
+    else:
+        for spectrum_type in backend.Spectrum.spectrum_type.choices:
+            while backend.compact(spectrum_type, True):
+                pass
+            if memcache.get(spectrum_type + '_compacting'):
+                raise common.ServerError("Matcher is still being compacted.")
+    job.state = "done"
+    job.put()
+
+def _merge(job, lease):
+    '''
+    Merge the next few finished chunks into the new Matchers, then queue the
+    next step.
+    
+    The task takes a lease on the job first, and only the task holding it
+    merges and queues the step after, so queueing this step more than once
+    does not start a second chain of merges. A lease is given up if its task
+    runs out of time, and the task queue retries a failed task with the same
+    lease, so it can take it again. Merging a spectrum twice changes
+    nothing, so a merge run again after failing part way does no harm.
+    
+    @param job: The job rebuilding the Matchers
+    @type  job: L{jobs.Job}
+    @param lease: Lease to merge the chunks under
+    @type  lease: C{str}
+    '''
+    now = datetime.datetime.now()
+    def take_lease():
+        leasing = Job.get(job.key())
+        if (leasing.lease not in (None, lease) and
+            leasing.leased > now - datetime.timedelta(seconds=LEASE_TIME)):
+            return None
+        leasing.lease = lease
+        leasing.leased = now
+        leasing.put()
+        return leasing
+    leased = db.run_in_transaction(take_lease)
+    if leased is None:
+        # Another task is merging, and will queue the step after.
+        return
+    merged = min(leased.merged + MERGE_CHUNKS, leased.chunks)
+    names = ["chunk%d" % index for index in xrange(leased.merged, merged)]
+    entries = []
+    for chunk in JobChunk.get_by_key_name(names, parent=job):
+        entries.extend(chunk.entries)
+    backend.build_matchers(_generation(job), entries)
+    def count_merged():
+        merging = Job.get(job.key())
+        if merging.lease != lease:
+            # The lease ran out and another task took over.
+            return False
+        merging.merged = max(merging.merged, merged)
+        merging.lease = None
+        merging.put()
+        return True
+    if db.run_in_transaction(count_merged):
+        _queue_finish(job)
+
+def _queue_finish(job):
+    '''
+    Queue the step finishing a job, with a new lease to merge chunks under.
+    
+    @param job: The job
+    @type  job: L{jobs.Job}
+    '''
+    queue.add({"job": str(job.key()), "step": "finish", "lease": uuid.uuid4().hex})
+
+def _generation(job):
+    '''
+    Get the name of the generation of Matchers a job is building.
+    
+    @param job: The job rebuilding the Matchers
+    @type  job: L{jobs.Job}
+    @return: The name
+    @rtype: C{str}
+    '''
+    return "job%s" % job.key().id_or_name()
+
+def _fail(job, error):
+    '''
+    Mark a job as failed. A failed update gives up its new Matchers, so
+    compaction stops keeping changes for them.
+    
+    @param job: The job
+    @type  job: L{jobs.Job}
+    @param error: Why it failed
+    @type  error: C{str}
+    @raise common.ServerError: If a Matcher is being compacted, so the task
+    should be retried later
+    '''
+    if job.action == "update":
+        # Before the job is marked failed, so a retry still gets here.
+        for spectrum_type in backend.Spectrum.spectrum_type.choices:
+            backend.cancel_rebuild(spectrum_type, _generation(job))
+    def fail():
+        # Get the job again, so progress made since it was loaded is kept.
+        failed = Job.get(job.key())
+        failed.state = "failed"
+        failed.error = error[:500]
+        failed.put()
+    db.run_in_transaction(fail)
+
+class JobHandler(webapp.RequestHandler):
+    '''Run job tasks sent by the task queue.'''
+    
+    def post(self):
+        '''
+        Run the step of a job given in the request. If it raises, the task
+        queue retries it.
+        '''
+        run_task(self.request.get("job"), self.request.get("step"),
+                 self.request.get("chunk") or None, self.request.get("lease") or None,
+                 int(self.request.headers.get("X-AppEngine-TaskRetryCount", 0)))
+
+application = webapp.WSGIApplication([
+    (TASK_URL, JobHandler)
+], debug=True)
+
+def main():
+    run_wsgi_app(application)
+
+if __name__ == '__main__':
+    main()
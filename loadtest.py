@@ -0,0 +1,291 @@
+"""
+Load the API with a mix of requests from several threads at once and report
+the throughput and latency of every action, to size instances and catch
+throughput regressions before deploying.
+
+Usage:
+./loadtest.py [options] <sdk>
+ - sdk : Path to the Google App Engine SDK
+
+Options:
+ - --library : Number of spectra in the public library before the test
+   (defaults to 1000)
+ - --requests : Number of requests to make (defaults to 1000)
+ - --concurrency : Number of requests made at once (defaults to 4)
+ - --mix : Comma-separated actions and how often to make them, out of
+   "compare", "browse", "add" and "projects" (defaults to
+   compare=60,browse=25,projects=10,add=5)
+ - --gzip : Accept gzipped responses
+ - --output : File to also write the results to as JSON
+ - --seed : Seed for the synthetic spectra and the order of requests
+
+Requests go straight to frontend.application as a WSGI application in this
+process, with the SDK's local datastore and memcache stubs behind it, set up
+the same way as for benchmark.py. The library and every uploaded spectrum are
+made by benchmark.Generator. Compares and adds upload a new spectrum each as
+multipart/form-data, the same way the upload form does, browses get a random
+page of the public library, and everything is done as an admin. Each thread
+has its own address, so each has its own quota. Responses without a 2xx
+status are counted as errors and left out of the latencies.
+
+NOTE: Threads share one interpreter, so the concurrency shows how requests
+slow each other down on one instance rather than how many an instance with
+more cores would handle.
+
+@organization: The Cooper Union for the Advancement of the Science and the Arts
+@license: http://opensource.org/licenses/lgpl-3.0.html GNU Lesser General Public License v3.0
+@copyright: Copyright (c) 2010, Cooper Union (Some Right Reserved)
+"""
+
+import os
+import sys
+import time
+import urllib
+import Queue
+import StringIO
+import optparse
+import threading
+
+from benchmark import setup_stubs, summarize, Generator
+
+ACTIONS = ("compare", "browse", "add", "projects")
+"""Actions requests can be made for."""
+
+BATCH_SIZE = 100
+"""Number of spectra added to the library at once before the test."""
+
+BOUNDARY = "----loadtest-boundary"
+"""Boundary between the fields of multipart request bodies."""
+
+URLENCODED = "application/x-www-form-urlencoded"
+"""Content type of requests without an uploaded spectrum."""
+
+def multipart(fields, files):
+    """
+    Encode form fields and uploaded files as a multipart/form-data request
+    body.
+    
+    @param fields: Names and values of the fields
+    @type  fields: C{dict}
+    @param files: Names and contents of the files
+    @type  files: C{dict}
+    @return: Content type and body of the request
+    @rtype: C{tuple}
+    """
+    lines = []
+    for name, value in sorted(fields.items()):
+        lines.extend(["--" + BOUNDARY,
+                      'Content-Disposition: form-data; name="%s"' % name,
+                      "", str(value)])
+    for name, contents in sorted(files.items()):
+        lines.extend(["--" + BOUNDARY,
+                      'Content-Disposition: form-data; name="%s"; filename="%s.jdx"' % (name, name),
+                      "Content-Type: application/octet-stream", "", contents])
+    lines.extend(["--" + BOUNDARY + "--", ""])
+    return "multipart/form-data; boundary=" + BOUNDARY, "\r\n".join(lines)
+
+def plan(generator, actions, count, library):
+    """
+    Make the list of requests to send.
+    
+    @param generator: Where uploaded spectra come from
+    @type  generator: L{benchmark.Generator}
+    @param actions: Actions with how often to make them
+    @type  actions: C{list} of C{tuple}
+    @param count: Number of requests to make
+    @type  count: C{int}
+    @param library: Number of spectra in the library, for browsing
+    @type  library: C{int}
+    @return: Action, method, query string, content type and body of every
+    request
+    @rtype: C{list} of C{tuple}
+    """
+    rnd = generator.random
+    total = sum([weight for action, weight in actions])
+    requests = []
+    for index in xrange(count):
+        choice = rnd.uniform(0, total)
+        for action, weight in actions:
+            choice -= weight
+            if choice <= 0:
+                break
+        if action in ("compare", "add"):
+            # Only uploaded files reach the API as byte strings, so send the
+            # spectrum as one.
+            content_type, body = multipart({"action": action, "output": "json"},
+                                           {"spectrum": generator.spectrum(library + index)})
+            requests.append((action, "POST", "", content_type, body))
+        elif action == "browse":
+            query = urllib.urlencode({"action": "browse", "output": "json", "limit": 10,
+                                      "offset": rnd.randint(0, max(library - 10, 0))})
+            requests.append((action, "GET", query, URLENCODED, ""))
+        else:
+            requests.append((action, "GET", "action=projects&output=json", URLENCODED, ""))
+    return requests
+
+def call(application, method, query, content_type, body, address, gzip):
+    """
+    Send a request to a WSGI application.
+    
+    @param application: Application to send the request to
+    @type  application: C{function}
+    @param method: HTTP method of the request
+    @type  method: C{str}
+    @param query: Query string of the request
+    @type  query: C{str}
+    @param content_type: Content type of the body
+    @type  content_type: C{str}
+    @param body: Body of the request
+    @type  body: C{str}
+    @param address: Address the request comes from
+    @type  address: C{str}
+    @param gzip: Whether to accept gzipped responses
+    @type  gzip: C{bool}
+    @return: Status code of the response
+    @rtype: C{int}
+    """
+    environ = {"REQUEST_METHOD": method, "SCRIPT_NAME": "", "PATH_INFO": "/api",
+               "QUERY_STRING": query, "CONTENT_TYPE": content_type,
+               "CONTENT_LENGTH": str(len(body)), "SERVER_NAME": "localhost",
+               "SERVER_PORT": "8080", "SERVER_PROTOCOL": "HTTP/1.1", "REMOTE_ADDR": address,
+               "wsgi.version": (1, 0), "wsgi.url_scheme": "http",
+               "wsgi.input": StringIO.StringIO(body), "wsgi.errors": sys.stderr,
+               "wsgi.multithread": True, "wsgi.multiprocess": False, "wsgi.run_once": False}
+    if gzip:
+        environ["HTTP_ACCEPT_ENCODING"] = "gzip"
+    status = []
+    def start_response(line, headers, exc_info=None):
+        status.append(int(line.split()[0]))
+    result = application(environ, start_response)
+    try:
+        for chunk in result:
+            pass
+    finally:
+        if hasattr(result, "close"):
+            result.close()
+    return status[0]
+
+def worker(application, requests, results, address, gzip):
+    """
+    Send requests from a queue until it is empty.
+    
+    @param application: Application to send the requests to
+    @type  application: C{function}
+    @param requests: Requests to send
+    @type  requests: C{Queue.Queue}
+    @param results: List to add the action, status and time of each request to
+    @type  results: C{list}
+    @param address: Address the requests come from
+    @type  address: C{str}
+    @param gzip: Whether to accept gzipped responses
+    @type  gzip: C{bool}
+    """
+    while True:
+        try:
+            action, method, query, content_type, body = requests.get_nowait()
+        except Queue.Empty:
+            return
+        start = time.time()
+        status = call(application, method, query, content_type, body, address, gzip)
+        results.append((action, status, time.time() - start))
+
+def run(sdk, options, actions):
+    """
+    Fill the library, then send every request and summarize how they went.
+    
+    @param sdk: Path to the Google App Engine SDK
+    @type  sdk: C{str}
+    @param options: Command line options
+    @type  options: C{optparse.Values}
+    @param actions: Actions with how often to make them
+    @type  actions: C{list} of C{tuple}
+    @return: Throughput and latencies overall and by action
+    @rtype: C{dict}
+    """
+    setup_stubs(sdk)
+    os.environ["USER_EMAIL"] = "loadtest@example.com"
+    os.environ["USER_IS_ADMIN"] = "1"
+    import backend
+    import frontend
+    here = os.path.dirname(os.path.abspath(__file__))
+    generator = Generator(open(os.path.join(here, "jcamp-test.jdx")).read(), options.seed)
+    for start in xrange(0, options.library, BATCH_SIZE):
+        backend.add_many([generator.spectrum(index) for index
+                          in xrange(start, min(start + BATCH_SIZE, options.library))])
+    requests = Queue.Queue()
+    for request in plan(generator, actions, options.requests, options.library):
+        requests.put(request)
+    results = []
+    threads = [threading.Thread(target=worker, args=(frontend.application, requests, results,
+                                                     "10.0.0.%d" % (index + 1), options.gzip))
+               for index in xrange(options.concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    # Failed requests are usually quicker, so only time the ones that worked.
+    succeeded = [result for result in results if 200 <= result[1] < 300]
+    report = {"elapsed": elapsed, "throughput": len(succeeded) / elapsed,
+              "errors": len(results) - len(succeeded), "actions": {}}
+    for action, weight in actions:
+        times = [seconds for name, status, seconds in succeeded if name == action]
+        summary = summarize(times)
+        summary["throughput"] = len(times) / elapsed
+        summary["errors"] = len([status for name, status, seconds in results
+                                 if name == action]) - len(times)
+        report["actions"][action] = summary
+    return report
+
+def main():
+    """Run the load test given on the command line and print the results."""
+    parser = optparse.OptionParser(usage="%prog [options] <sdk>")
+    parser.add_option("--library", type="int", default=1000,
+                      help="spectra in the public library before the test")
+    parser.add_option("--requests", type="int", default=1000,
+                      help="number of requests to make")
+    parser.add_option("--concurrency", type="int", default=4,
+                      help="number of requests made at once")
+    parser.add_option("--mix", default="compare=60,browse=25,projects=10,add=5",
+                      help="comma-separated actions and how often to make them")
+    parser.add_option("--gzip", action="store_true", default=False,
+                      help="accept gzipped responses")
+    parser.add_option("--output", help="file to also write the results to as JSON")
+    parser.add_option("--seed", type="int", default=0,
+                      help="seed for the synthetic spectra and the order of requests")
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error("Need the path to the Google App Engine SDK.")
+    actions = []
+    for item in options.mix.split(","):
+        action, weight = item.split("=")
+        if action not in ACTIONS:
+            parser.error("Invalid action %s in the mix." % action)
+        actions.append((action, float(weight)))
+    report = run(os.path.abspath(args[0]), options, actions)
+    print "%d requests in %.2f seconds, %d errors, %.1f successful per second" % (
+        options.requests, report["elapsed"], report["errors"], report["throughput"])
+    print "%-9s %6s %6s %8s %8s %8s %8s" % ("action", "count", "errors", "per sec",
+                                            "p50 ms", "p95 ms", "p99 ms")
+    for action, weight in actions:
+        summary = report["actions"][action]
+        if not summary["count"]:
+            if summary["errors"]:
+                print "%-9s %6d %6d" % (action, 0, summary["errors"])
+            continue
+        print "%-9s %6d %6d %8.1f %8.1f %8.1f %8.1f" % (
+            action, summary["count"], summary["errors"], summary["throughput"],
+            summary["p50"] * 1000, summary["p95"] * 1000, summary["p99"] * 1000)
+    if options.output:
+        from django.utils import simplejson
+        report.update({"created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                       "python": sys.version.split()[0], "library": options.library,
+                       "concurrency": options.concurrency, "mix": dict(actions),
+                       "seed": options.seed})
+        output = open(options.output, "w")
+        simplejson.dump(report, output, indent=2, sort_keys=True)
+        output.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,696 @@
+'''
+Provide the similarity metrics used to compare spectra to each other.
+
+Every metric is registered under the name used for it in the API. A metric
+takes the integrated data of one spectrum and a matrix holding the data of
+any number of other spectra, one row per spectrum, and returns the error of
+each row in a single call. Lower errors mean more similar spectra.
+
+@organization: The Cooper Union for the Advancement of the Science and the Arts
+@license: http://opensource.org/licenses/lgpl-3.0.html GNU Lesser General Public License v3.0
+@copyright: Copyright (c) 2010, Cooper Union (Some Right Reserved)
+'''
+
+import math
+import heapq # heapq.heappush, heapq.heapreplace, heapq.nsmallest
+import operator # operator.sub, operator.mul, operator.itemgetter
+
+import common
+
+METRICS = {}
+'''Registered metrics by name
+@type: C{dict}'''
+
+ABANDON_CHUNK = 8
+'''Number of bins compared between checks against the current k-th best
+error when scoring with early abandoning
+@type: C{int}'''
+
+DTW_BAND = 3
+'''Number of bins a spectrum may be shifted by in either direction when
+matching with dynamic time warping
+@type: C{int}'''
+
+def register(name):
+    '''
+    Register a function as a metric under the given name.
+    
+    @param name: Name of the metric, as used in the API
+    @type  name: C{str}
+    @return: Decorator registering the function
+    @rtype: C{function}
+    '''
+    def decorator(metric):
+        METRICS[name] = metric
+        return metric
+    return decorator
+
+def get(name):
+    '''
+    Get a registered metric by name.
+    
+    @param name: Name of the metric
+    @type  name: C{str}
+    @return: The metric
+    @rtype: C{function}
+    @raise common.InputError: If no metric is registered under the name
+    '''
+    if name not in METRICS:
+        raise common.InputError(name, "Invalid algorithm selection.")
+    return METRICS[name]
+
+def score(name, query, matrix):
+    '''
+    Score the query against every row of the matrix with the given metric.
+    
+    @param name: Name of the metric
+    @type  name: C{str}
+    @param query: Integrated data of the spectrum to compare
+    @type  query: C{list} of C{float}
+    @param matrix: Integrated data of the spectra to compare against
+    @type  matrix: C{list} of C{list} of C{float}
+    @return: Error of each row
+    @rtype: C{list} of C{float}
+    @raise common.InputError: If no metric is registered under the name
+    @raise common.ServerError: If there are invalid spectra in the database
+    '''
+    metric = get(name)
+    if not query or [row for row in matrix if not row]:
+        raise common.ServerError("Invalid spectra in the database.")
+    return metric(query, matrix)
+
+def top_k(name, query, matrix, k):
+    '''
+    Find the rows of the matrix with the lowest errors for the given metric.
+    
+    For Bove's algorithm, least squares and Euclidean distance, the partial
+    error of a row can only grow as more bins are compared. Rows are then
+    abandoned as soon as their partial error passes the current k-th best,
+    comparing the bins where the query is largest first since those tend to
+    hold the largest differences. Dynamic time warping is only run on rows
+    whose LB_Keogh lower bound is below the current k-th best. Other metrics
+    score every row in full.
+    
+    @param name: Name of the metric
+    @type  name: C{str}
+    @param query: Integrated data of the spectrum to compare
+    @type  query: C{list} of C{float}
+    @param matrix: Integrated data of the spectra to compare against
+    @type  matrix: C{list} of C{list} of C{float}
+    @param k: Number of rows to find
+    @type  k: C{int}
+    @return: Error and index of the best rows, lowest error first
+    @rtype: C{list} of C{tuple}
+    @raise common.InputError: If no metric is registered under the name
+    @raise common.ServerError: If there are invalid spectra in the database
+    '''
+    if name == "dtw":
+        return _top_k_dtw(query, matrix, k)
+    if name not in ("bove", "leastsquares", "euclidean"):
+        errors = score(name, query, matrix)
+        return heapq.nsmallest(k, [(error, index) for index, error in enumerate(errors)])
+    get(name)
+    if not query or [row for row in matrix if not row]:
+        raise common.ServerError("Invalid spectra in the database.")
+    if k <= 0:
+        return []
+    length = min([len(query)] + [len(row) for row in matrix])
+    # Visit the bins in order of the query's magnitude, a chunk at a time.
+    order = sorted(xrange(length), key=lambda i: -abs(query[i]))
+    chunks = []
+    for start in xrange(0, length, ABANDON_CHUNK):
+        getter = operator.itemgetter(*order[start:start + ABANDON_CHUNK])
+        values = getter(query)
+        if not isinstance(values, tuple):
+            # A chunk of one bin gives back a bare value.
+            getter = _single_getter(getter)
+            values = (values,)
+        chunks.append((getter, values))
+    # Keep the k best rows so far in a heap with the worst on top.
+    best = []
+    threshold = float("inf")
+    for index, row in enumerate(matrix):
+        error = 0.0
+        for getter, values in chunks:
+            differences = map(operator.sub, values, getter(row))
+            if name == "bove":
+                error = max(error, max(map(abs, differences)))
+            else:
+                error += sum(map(operator.mul, differences, differences))
+            if error > threshold:
+                break
+        else:
+            if len(best) < k:
+                heapq.heappush(best, (-error, index))
+            else:
+                heapq.heapreplace(best, (-error, index))
+            if len(best) == k:
+                threshold = -best[0][0]
+    results = sorted([(-error, index) for error, index in best])
+    if name == "euclidean":
+        results = [(math.sqrt(error / length), index) for error, index in results]
+    return results
+
+def cascade(name, query, matrix, k, levels):
+    '''
+    Find the rows of the matrix with the lowest errors, ranking them at
+    coarse resolutions first.
+    
+    Each level holds the query and matrix summed down to fewer bins. When a
+    coarse bin is the sum of at most g fine bins, its Bove error divided by g
+    is a lower bound on the fine Bove error, and so is its sum of squares
+    divided by g for the fine sum of squares. Working from the coarsest level
+    up, rows whose bound is above the k-th best error among the rows with the
+    lowest bounds are dropped, and only the rest are scored at full
+    resolution. The result is the same as L{top_k}.
+    
+    @param name: Name of the metric
+    @type  name: C{str}
+    @param query: Integrated data of the spectrum to compare
+    @type  query: C{list} of C{float}
+    @param matrix: Integrated data of the spectra to compare against
+    @type  matrix: C{list} of C{list} of C{float}
+    @param k: Number of rows to find
+    @type  k: C{int}
+    @param levels: Downsampled query and matrix for each resolution, coarsest
+    first
+    @type  levels: C{list} of C{tuple}
+    @return: Error and index of the best rows, lowest error first
+    @rtype: C{list} of C{tuple}
+    @raise common.InputError: If no metric is registered under the name
+    @raise common.ServerError: If there are invalid spectra in the database
+    '''
+    if name not in ("bove", "leastsquares", "euclidean") or len(matrix) <= k or k <= 0:
+        return top_k(name, query, matrix, k)
+    # Euclidean distance is ranked by its sum of squares.
+    if name == "bove":
+        bound_name = "bove"
+    else:
+        bound_name = "leastsquares"
+    candidates = range(len(matrix))
+    bounds = [0.0] * len(matrix)
+    threshold = None
+    for coarse_query, coarse_matrix in levels:
+        group = int(math.ceil(float(len(query)) / len(coarse_query)))
+        errors = score(bound_name, coarse_query, [coarse_matrix[i] for i in candidates])
+        for index, error in zip(candidates, errors):
+            bounds[index] = max(bounds[index], error / group)
+        candidates.sort(key=bounds.__getitem__)
+        if threshold is None:
+            # The rows most likely to be best give the error to beat.
+            seeds = top_k(bound_name, query, [matrix[i] for i in candidates[:k]], k)
+            threshold = seeds[-1][0]
+        candidates = [index for index in candidates if bounds[index] <= threshold]
+    best = top_k(name, query, [matrix[i] for i in candidates], k)
+    return [(error, candidates[index]) for error, index in best]
+
+def pairwise(name, matrix):
+    '''
+    Score every row of the matrix against every other row.
+    
+    All registered metrics are symmetric, so each row is only scored against
+    the rows after it, in one call per row.
+    
+    @param name: Name of the metric
+    @type  name: C{str}
+    @param matrix: Integrated data of the spectra to compare
+    @type  matrix: C{list} of C{list} of C{float}
+    @return: Error between each pair of rows
+    @rtype: C{list} of C{list} of C{float}
+    @raise common.InputError: If no metric is registered under the name
+    @raise common.ServerError: If there are invalid spectra in the database
+    '''
+    distances = [[0.0] * len(matrix) for row in matrix]
+    for i in xrange(len(matrix) - 1):
+        errors = score(name, matrix[i], matrix[i + 1:])
+        for j, error in enumerate(errors):
+            distances[i][i + 1 + j] = distances[i + 1 + j][i] = error
+    return distances
+
+def nearest(distances):
+    '''
+    Find the nearest other row for each row of a distance matrix.
+    
+    @param distances: Symmetric matrix of errors between rows
+    @type  distances: C{list} of C{list} of C{float}
+    @return: Index of and error to the nearest row, or None for a lone row
+    @rtype: C{list} of C{tuple}
+    '''
+    result = []
+    for i, row in enumerate(distances):
+        others = [(error, j) for j, error in enumerate(row) if j != i]
+        if others:
+            error, j = min(others)
+            result.append((j, error))
+        else:
+            result.append((None, None))
+    return result
+
+def linkage(distances):
+    '''
+    Cluster rows of a distance matrix hierarchically using average linkage.
+    
+    Rows start as clusters 0 to n - 1, and the cluster made by the i-th
+    merge is numbered n + i. The nearest neighbour of every cluster is kept
+    so each merge only has to look at one candidate per cluster.
+    
+    @param distances: Symmetric matrix of errors between rows
+    @type  distances: C{list} of C{list} of C{float}
+    @return: The two clusters merged, the error between them, and the size
+    of the new cluster, for each merge in order
+    @rtype: C{list} of C{tuple}
+    '''
+    count = len(distances)
+    # Work on a copy, indexed by the slot each cluster occupies.
+    current = [list(row) for row in distances]
+    labels = range(count)
+    sizes = [1] * count
+    active = set(range(count))
+    neighbours = {}
+    def find_nearest(i):
+        others = [(current[i][j], j) for j in active if j != i]
+        neighbours[i] = others and min(others) or (None, None)
+    for i in active:
+        find_nearest(i)
+    merges = []
+    while len(active) > 1:
+        error, i = min([(neighbours[i][0], i) for i in active])
+        j = neighbours[i][1]
+        # Merge j into i and update distances by Lance-Williams.
+        for other in active:
+            if other not in (i, j):
+                current[i][other] = current[other][i] = (
+                    (sizes[i] * current[i][other] + sizes[j] * current[j][other]) /
+                    (sizes[i] + sizes[j]))
+        merges.append((labels[i], labels[j], error, sizes[i] + sizes[j]))
+        sizes[i] += sizes[j]
+        labels[i] = count + len(merges) - 1
+        active.remove(j)
+        del neighbours[j]
+        for other in active:
+            if other == i or neighbours[other][1] in (i, j):
+                find_nearest(other)
+            elif current[other][i] < neighbours[other][0]:
+                neighbours[other] = (current[other][i], i)
+    return merges
+
+def nnls(columns, target, tolerance=1e-10):
+    '''
+    Find the non-negative weights of the columns that best add up to the
+    target, using the Lawson-Hanson active set method.
+    
+    Each least squares step only involves the columns currently given a
+    weight, so it is solved through their normal equations. Their Cholesky
+    factor is updated as columns get or lose a weight rather than worked out
+    again, so each step costs the square of the number of columns used, not
+    the cube. The dot products between columns are only computed when a
+    column first gets a weight, so the cost grows with the number of columns
+    used rather than offered.
+    
+    @param columns: Integrated data of the spectra to mix
+    @type  columns: C{list} of C{list} of C{float}
+    @param target: Integrated data of the mixture
+    @type  target: C{list} of C{float}
+    @param tolerance: How close to zero counts as zero
+    @type  tolerance: C{float}
+    @return: Weight of each column and the norm of the residual
+    @rtype: C{tuple} of C{list} of C{float} and C{float}
+    '''
+    count = len(columns)
+    weights = [0.0] * count
+    correlations = [_dot(column, target) for column in columns]
+    passive = []
+    # Dot products of every column with each column given a weight, in the
+    # same order, and the Cholesky factor of those between the latter.
+    products = [[] for column in columns]
+    lower = []
+    for iteration in xrange(3 * count):
+        # Gradient of the residual for every column not given a weight yet.
+        current = [weights[p] for p in passive]
+        gradient = [(correlations[j] - _dot(products[j], current), j)
+                    for j in xrange(count) if j not in passive]
+        if not gradient:
+            break
+        value, entering = max(gradient)
+        if value <= tolerance:
+            break
+        # Products with the columns already given a weight were worked out
+        # when those columns got theirs.
+        for index, p in enumerate(passive):
+            products[p].append(products[entering][index])
+        for j in xrange(count):
+            if len(products[j]) == len(passive):
+                products[j].append(_dot(columns[j], columns[entering]))
+        passive.append(entering)
+        _cholesky_add(lower, products[entering])
+        while True:
+            solution = _cholesky_solve(lower, [correlations[i] for i in passive])
+            if min(solution) > tolerance:
+                for i, value in zip(passive, solution):
+                    weights[i] = value
+                break
+            # Step towards the solution until a weight hits zero, then drop
+            # the columns that did. A column already at zero that stays there
+            # gives no step, so it is dropped without moving the others.
+            steps = [weights[i] / (weights[i] - value)
+                     for i, value in zip(passive, solution)
+                     if value <= tolerance and weights[i] > value]
+            step = min(steps or [0.0])
+            for i, value in zip(passive, solution):
+                weights[i] += step * (value - weights[i])
+            for index in reversed(xrange(len(passive))):
+                if weights[passive[index]] <= tolerance:
+                    weights[passive.pop(index)] = 0.0
+                    _cholesky_remove(lower, index)
+                    for row in products:
+                        del row[index]
+            if not passive:
+                break
+    # Residual of the mixture.
+    mixture = [0.0] * len(target)
+    for i in passive:
+        mixture = map(operator.add, mixture, [weights[i] * value for value in columns[i]])
+    residual = math.sqrt(sum([difference * difference
+                              for difference in _differences(target, mixture)]))
+    return weights, residual
+
+def _cholesky_add(lower, products):
+    '''
+    Extend the Cholesky factor of a symmetric positive definite matrix by a
+    row and column.
+    
+    @param lower: Rows of the lower triangular factor, each as long as its
+    index plus one, extended in place
+    @type  lower: C{list} of C{list} of C{float}
+    @param products: The new row of the matrix, diagonal last
+    @type  products: C{list} of C{float}
+    '''
+    row = []
+    for i, factor in enumerate(lower):
+        row.append((products[i] - _dot(factor, row)) / factor[i])
+    # Guard against columns that are nearly the same.
+    row.append(math.sqrt(max(products[len(lower)] - _dot(row, row), 1e-12)))
+    lower.append(row)
+
+def _cholesky_remove(lower, index):
+    '''
+    Drop a row and column from the matrix behind a Cholesky factor.
+    
+    Removing the row from the factor leaves one entry above the diagonal in
+    each row after it, which Givens rotations fold back in.
+    
+    @param lower: Rows of the lower triangular factor, each as long as its
+    index plus one, changed in place
+    @type  lower: C{list} of C{list} of C{float}
+    @param index: Index of the row and column to drop
+    @type  index: C{int}
+    '''
+    del lower[index]
+    for j in xrange(index, len(lower)):
+        a, b = lower[j][j], lower[j][j + 1]
+        radius = math.hypot(a, b)
+        cosine, sine = a / radius, b / radius
+        for row in lower[j:]:
+            row[j], row[j + 1] = (cosine * row[j] + sine * row[j + 1],
+                                  cosine * row[j + 1] - sine * row[j])
+        del lower[j][j + 1]
+
+def _cholesky_solve(lower, vector):
+    '''
+    Solve a symmetric positive definite system given its Cholesky factor.
+    
+    @param lower: Rows of the lower triangular factor, each as long as its
+    index plus one
+    @type  lower: C{list} of C{list} of C{float}
+    @param vector: The system's right hand side
+    @type  vector: C{list} of C{float}
+    @return: The solution
+    @rtype: C{list} of C{float}
+    '''
+    size = len(vector)
+    forward = []
+    for i in xrange(size):
+        forward.append((vector[i] - _dot(lower[i], forward)) / lower[i][i])
+    solution = [0.0] * size
+    for i in reversed(xrange(size)):
+        solution[i] = (forward[i] - sum([lower[m][i] * solution[m]
+                                         for m in xrange(i + 1, size)])) / lower[i][i]
+    return solution
+
+def downsample(data, bins):
+    '''
+    Sum adjacent bins of integrated data down to fewer bins.
+    
+    @param data: Integrated data to downsample
+    @type  data: C{list} of C{float}
+    @param bins: Number of bins to sum down to
+    @type  bins: C{int}
+    @return: The downsampled data
+    @rtype: C{list} of C{float}
+    '''
+    group = int(math.ceil(float(len(data)) / bins))
+    return [sum(data[start:start + group]) for start in xrange(0, len(data), group)]
+
+def _top_k_dtw(query, matrix, k):
+    '''
+    Find the rows with the lowest dynamic time warping errors.
+    
+    Rows are visited in order of their LB_Keogh bound, the distance from the
+    row to the envelope of the query over the warping band. Since any warping
+    path matches each bin of the row to a bin of the query within the band,
+    the bound never exceeds the real error, so once it passes the k-th best
+    error no later row can do better.
+    
+    @param query: Integrated data of the spectrum to compare
+    @type  query: C{list} of C{float}
+    @param matrix: Integrated data of the spectra to compare against
+    @type  matrix: C{list} of C{list} of C{float}
+    @param k: Number of rows to find
+    @type  k: C{int}
+    @return: Error and index of the best rows, lowest error first
+    @rtype: C{list} of C{tuple}
+    @raise common.ServerError: If there are invalid spectra in the database
+    '''
+    if not query or [row for row in matrix if not row]:
+        raise common.ServerError("Invalid spectra in the database.")
+    if k <= 0:
+        return []
+    length = len(query)
+    upper = [max(query[max(0, i - DTW_BAND):i + DTW_BAND + 1]) for i in xrange(length)]
+    lower = [min(query[max(0, i - DTW_BAND):i + DTW_BAND + 1]) for i in xrange(length)]
+    bounds = []
+    for index, row in enumerate(matrix):
+        row = row[:length]
+        above = sum([value for value in map(operator.sub, row, upper[:len(row)]) if value > 0])
+        below = sum([value for value in map(operator.sub, lower[:len(row)], row) if value > 0])
+        bounds.append((above + below, index))
+    bounds.sort()
+    best = []
+    threshold = float("inf")
+    for bound, index in bounds:
+        if bound > threshold:
+            break
+        error = _dtw(query, matrix[index], DTW_BAND, threshold)
+        if error > threshold:
+            continue
+        if len(best) < k:
+            heapq.heappush(best, (-error, index))
+        else:
+            heapq.heapreplace(best, (-error, index))
+        if len(best) == k:
+            threshold = -best[0][0]
+    return sorted([(-error, index) for error, index in best])
+
+def _dtw(a, b, band, threshold=float("inf")):
+    '''
+    Calculate the dynamic time warping distance between two spectra.
+    
+    Bins may only be matched to bins at most band away (a Sakoe-Chiba band),
+    and the cost of matching two bins is their absolute difference. Only the
+    band of each row of the cost matrix is kept, indexed from its left edge.
+    
+    @param a: Integrated data of one spectrum
+    @type  a: C{list} of C{float}
+    @param b: Integrated data of the other spectrum
+    @type  b: C{list} of C{float}
+    @param band: Maximum number of bins to shift by
+    @type  band: C{int}
+    @param threshold: Error above which to give up
+    @type  threshold: C{float}
+    @return: The distance, or infinity if it is above the threshold
+    @rtype: C{float}
+    '''
+    length = min(len(a), len(b))
+    width = 2 * band + 1
+    infinity = float("inf")
+    previous = [infinity] * width
+    for i in xrange(length):
+        current = [infinity] * width
+        value = a[i]
+        for offset in xrange(max(0, band - i), min(width, length - i + band)):
+            j = i + offset - band
+            if i == 0 and j == 0:
+                best = 0.0
+            else:
+                # Diagonal, then the cells above and to the left.
+                best = previous[offset]
+                if offset + 1 < width and previous[offset + 1] < best:
+                    best = previous[offset + 1]
+                if offset > 0 and current[offset - 1] < best:
+                    best = current[offset - 1]
+            current[offset] = abs(value - b[j]) + best
+        if min(current) > threshold:
+            return infinity
+        previous = current
+    return previous[band]
+
+def _single_getter(getter):
+    '''
+    Wrap an item getter for a single index so it returns a tuple.
+    
+    @param getter: Item getter for one index
+    @type  getter: C{operator.itemgetter}
+    @return: Function returning a one-item tuple
+    @rtype: C{function}
+    '''
+    return lambda row: (getter(row),)
+
+def _differences(query, row):
+    '''
+    Get the bin-by-bin differences between two spectra.
+    
+    @param query: Integrated data of one spectrum
+    @type  query: C{list} of C{float}
+    @param row: Integrated data of the other spectrum
+    @type  row: C{list} of C{float}
+    @return: Differences, as long as the shorter of the two
+    @rtype: C{list} of C{float}
+    '''
+    length = min(len(query), len(row))
+    return map(operator.sub, query[:length], row[:length])
+
+def _dot(a, b):
+    '''
+    Get the dot product of two vectors.
+    
+    @param a: A vector
+    @type  a: C{list} of C{float}
+    @param b: Another vector
+    @type  b: C{list} of C{float}
+    @return: The dot product
+    @rtype: C{float}
+    '''
+    length = min(len(a), len(b))
+    return sum(map(operator.mul, a[:length], b[:length]))
+
+@register("bove")
+def bove(query, matrix):
+    '''
+    Calculate errors using Bove's algorithm, the largest difference in any
+    one bin.
+    
+    @param query: Integrated data of the spectrum to compare
+    @type  query: C{list} of C{float}
+    @param matrix: Integrated data of the spectra to compare against
+    @type  matrix: C{list} of C{list} of C{float}
+    @return: Error of each row
+    @rtype: C{list} of C{float}
+    '''
+    return [max(map(abs, _differences(query, row))) for row in matrix]
+
+@register("leastsquares")
+def least_squares(query, matrix):
+    '''
+    Calculate errors as the sum of the squared differences of each bin.
+    
+    @param query: Integrated data of the spectrum to compare
+    @type  query: C{list} of C{float}
+    @param matrix: Integrated data of the spectra to compare against
+    @type  matrix: C{list} of C{list} of C{float}
+    @return: Error of each row
+    @rtype: C{list} of C{float}
+    '''
+    errors = []
+    for row in matrix:
+        differences = _differences(query, row)
+        errors.append(sum(map(operator.mul, differences, differences)))
+    return errors
+
+@register("euclidean")
+def euclidean(query, matrix):
+    '''
+    Calculate errors as the Euclidean distance normalized by the number of
+    bins, i.e. the root mean square difference.
+    
+    @param query: Integrated data of the spectrum to compare
+    @type  query: C{list} of C{float}
+    @param matrix: Integrated data of the spectra to compare against
+    @type  matrix: C{list} of C{list} of C{float}
+    @return: Error of each row
+    @rtype: C{list} of C{float}
+    '''
+    errors = []
+    for row in matrix:
+        differences = _differences(query, row)
+        errors.append(math.sqrt(sum(map(operator.mul, differences, differences)) /
+                                len(differences)))
+    return errors
+
+@register("cosine")
+def cosine(query, matrix):
+    '''
+    Calculate errors as one minus the cosine of the angle between spectra,
+    which ignores differences in concentration.
+    
+    @param query: Integrated data of the spectrum to compare
+    @type  query: C{list} of C{float}
+    @param matrix: Integrated data of the spectra to compare against
+    @type  matrix: C{list} of C{list} of C{float}
+    @return: Error of each row
+    @rtype: C{list} of C{float}
+    '''
+    query_norm = math.sqrt(_dot(query, query))
+    errors = []
+    for row in matrix:
+        norm = query_norm * math.sqrt(_dot(row, row))
+        if norm == 0:
+            errors.append(1.0)
+        else:
+            errors.append(1.0 - _dot(query, row) / norm)
+    return errors
+
+@register("pearson")
+def pearson(query, matrix):
+    '''
+    Calculate errors as one minus the Pearson correlation between spectra,
+    which ignores both baseline offsets and differences in concentration.
+    
+    @param query: Integrated data of the spectrum to compare
+    @type  query: C{list} of C{float}
+    @param matrix: Integrated data of the spectra to compare against
+    @type  matrix: C{list} of C{list} of C{float}
+    @return: Error of each row
+    @rtype: C{list} of C{float}
+    '''
+    query_mean = sum(query) / len(query)
+    centered = [value - query_mean for value in query]
+    matrix_centered = []
+    for row in matrix:
+        mean = sum(row) / len(row)
+        matrix_centered.append([value - mean for value in row])
+    return cosine(centered, matrix_centered)
+
+@register("dtw")
+def dtw(query, matrix):
+    '''
+    Calculate errors using dynamic time warping, which tolerates spectra
+    shifted by up to L{DTW_BAND} bins, as caused by instrument drift.
+    
+    @param query: Integrated data of the spectrum to compare
+    @type  query: C{list} of C{float}
+    @param matrix: Integrated data of the spectra to compare against
+    @type  matrix: C{list} of C{list} of C{float}
+    @return: Error of each row
+    @rtype: C{list} of C{float}
+    '''
+    return [_dtw(query, row, DTW_BAND) for row in matrix]
@@ -0,0 +1,197 @@
+'''
+Provide the preprocessing stages that can be applied to integrated spectrum
+data before comparing it.
+
+Every stage is registered under the name used for it in the API and takes
+the raw integrated data of a spectrum. Stages are run once when a spectrum
+is stored, and their results kept beside it, so choosing one at query time
+does not cost anything extra for the spectra in the database.
+
+@organization: The Cooper Union for the Advancement of the Science and the Arts
+@license: http://opensource.org/licenses/lgpl-3.0.html GNU Lesser General Public License v3.0
+@copyright: Copyright (c) 2010, Cooper Union (Some Right Reserved)
+'''
+
+import math
+
+import common
+
+STAGES = {}
+'''Registered preprocessing stages by name
+@type: C{dict}'''
+
+ALS_SMOOTHNESS = 1e5
+'''How strongly the asymmetric least squares baseline is kept smooth
+@type: C{float}'''
+
+ALS_ASYMMETRY = 0.01
+'''Weight given to points above the asymmetric least squares baseline, with
+points below it getting one minus this
+@type: C{float}'''
+
+ALS_ITERATIONS = 10
+'''Number of times the asymmetric least squares weights are updated
+@type: C{int}'''
+
+SAVITZKY_GOLAY_HALF_WIDTH = 3
+'''Number of bins on either side used by the Savitzky-Golay derivative
+@type: C{int}'''
+
+def register(name):
+    '''
+    Register a function as a preprocessing stage under the given name.
+    
+    @param name: Name of the stage, as used in the API
+    @type  name: C{str}
+    @return: Decorator registering the function
+    @rtype: C{function}
+    '''
+    def decorator(stage):
+        STAGES[name] = stage
+        return stage
+    return decorator
+
+def get(name):
+    '''
+    Get a registered preprocessing stage by name.
+    
+    @param name: Name of the stage
+    @type  name: C{str}
+    @return: The stage
+    @rtype: C{function}
+    @raise common.InputError: If no stage is registered under the name
+    '''
+    if name not in STAGES:
+        raise common.InputError(name, "Invalid preprocessing stage.")
+    return STAGES[name]
+
+@register("baseline")
+def baseline(data):
+    '''
+    Remove the baseline using asymmetric least squares.
+    
+    The baseline is the smooth curve that fits the data while points above
+    it, the peaks, count far less than points below it. It is found by
+    repeatedly solving the penalized least squares problem with updated
+    weights.
+    
+    @param data: Integrated data of a spectrum
+    @type  data: C{list} of C{float}
+    @return: The data with its baseline subtracted
+    @rtype: C{list} of C{float}
+    '''
+    length = len(data)
+    if length < 3:
+        return list(data)
+    # Penalty on the second differences of the baseline, as the three
+    # diagonals of its symmetric pentadiagonal matrix.
+    diagonal = [0.0] * length
+    first = [0.0] * (length - 1)
+    second = [0.0] * (length - 2)
+    for i in xrange(length - 2):
+        diagonal[i] += 1.0
+        diagonal[i + 1] += 4.0
+        diagonal[i + 2] += 1.0
+        first[i] -= 2.0
+        first[i + 1] -= 2.0
+        second[i] += 1.0
+    weights = [1.0] * length
+    for iteration in xrange(ALS_ITERATIONS):
+        fitted = _solve_pentadiagonal(
+            [weight + ALS_SMOOTHNESS * value for weight, value in zip(weights, diagonal)],
+            [ALS_SMOOTHNESS * value for value in first],
+            [ALS_SMOOTHNESS * value for value in second],
+            [weight * value for weight, value in zip(weights, data)])
+        weights = [value > fit and ALS_ASYMMETRY or 1 - ALS_ASYMMETRY
+                   for value, fit in zip(data, fitted)]
+    return [value - fit for value, fit in zip(data, fitted)]
+
+@register("derivative")
+def derivative(data):
+    '''
+    Take the first derivative using a Savitzky-Golay filter.
+    
+    For a quadratic fit, the derivative at the centre of the window is a
+    weighted sum of the bins around it, each weighted by its offset. Bins
+    past the edges are taken to equal the edge bins.
+    
+    @param data: Integrated data of a spectrum
+    @type  data: C{list} of C{float}
+    @return: The derivative of the data
+    @rtype: C{list} of C{float}
+    '''
+    half = SAVITZKY_GOLAY_HALF_WIDTH
+    length = len(data)
+    if not length:
+        return []
+    norm = float(sum([offset * offset for offset in xrange(-half, half + 1)]))
+    padded = [data[0]] * half + list(data) + [data[-1]] * half
+    return [sum([offset * padded[i + half + offset] for offset in xrange(1, half + 1)]) / norm -
+            sum([offset * padded[i + half - offset] for offset in xrange(1, half + 1)]) / norm
+            for i in xrange(length)]
+
+@register("normalized")
+def normalized(data):
+    '''
+    Scale the data to unit length, removing differences in concentration.
+    
+    @param data: Integrated data of a spectrum
+    @type  data: C{list} of C{float}
+    @return: The normalized data
+    @rtype: C{list} of C{float}
+    '''
+    norm = math.sqrt(sum([value * value for value in data]))
+    if norm == 0:
+        return list(data)
+    return [value / norm for value in data]
+
+def _solve_pentadiagonal(diagonal, first, second, vector):
+    '''
+    Solve a symmetric positive definite pentadiagonal system in linear time.
+    
+    The matrix is factored as L D L^T, where L has ones on its diagonal and
+    two diagonals below it.
+    
+    @param diagonal: Main diagonal of the matrix
+    @type  diagonal: C{list} of C{float}
+    @param first: First diagonal above (and below) the main one
+    @type  first: C{list} of C{float}
+    @param second: Second diagonal above (and below) the main one
+    @type  second: C{list} of C{float}
+    @param vector: The system's right hand side
+    @type  vector: C{list} of C{float}
+    @return: The solution
+    @rtype: C{list} of C{float}
+    '''
+    length = len(diagonal)
+    pivots = [0.0] * length
+    lower1 = [0.0] * length
+    lower2 = [0.0] * length
+    for i in xrange(length):
+        if i >= 2:
+            lower2[i] = second[i - 2] / pivots[i - 2]
+        if i >= 1:
+            value = first[i - 1]
+            if i >= 2:
+                value -= lower2[i] * pivots[i - 2] * lower1[i - 1]
+            lower1[i] = value / pivots[i - 1]
+        pivot = diagonal[i]
+        if i >= 1:
+            pivot -= lower1[i] * lower1[i] * pivots[i - 1]
+        if i >= 2:
+            pivot -= lower2[i] * lower2[i] * pivots[i - 2]
+        pivots[i] = pivot
+    # Forward substitution, scaling, then back substitution.
+    solution = list(vector)
+    for i in xrange(length):
+        if i >= 1:
+            solution[i] -= lower1[i] * solution[i - 1]
+        if i >= 2:
+            solution[i] -= lower2[i] * solution[i - 2]
+    solution = [value / pivot for value, pivot in zip(solution, pivots)]
+    for i in reversed(xrange(length)):
+        if i + 1 < length:
+            solution[i] -= lower1[i + 1] * solution[i + 1]
+        if i + 2 < length:
+            solution[i] -= lower2[i + 2] * solution[i + 2]
+    return solution
@@ -0,0 +1,12 @@
+"""
+Unit tests for the metrics and preprocessing stages.
+
+Run them from the top of the repository with the Google App Engine SDK on
+the path, since the modules under test import it:
+
+PYTHONPATH=<sdk> python -m unittest discover -s tests -t .
+
+@organization: The Cooper Union for the Advancement of the Science and the Arts
+@license: http://opensource.org/licenses/lgpl-3.0.html GNU Lesser General Public License v3.0
+@copyright: Copyright (c) 2010, Cooper Union (Some Right Reserved)
+"""
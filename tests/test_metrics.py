@@ -0,0 +1,226 @@
+"""
+Test the similarity metrics against straightforward implementations of
+what they compute.
+
+@organization: The Cooper Union for the Advancement of the Science and the Arts
+@license: http://opensource.org/licenses/lgpl-3.0.html GNU Lesser General Public License v3.0
+@copyright: Copyright (c) 2010, Cooper Union (Some Right Reserved)
+"""
+
+import random
+import unittest
+
+import metrics
+
+def make_spectra(rnd, count, length):
+    """
+    Make random integrated data for a number of spectra.
+    
+    @param rnd: Where the random values come from
+    @type  rnd: C{random.Random}
+    @param count: Number of spectra
+    @type  count: C{int}
+    @param length: Number of bins of each spectrum
+    @type  length: C{int}
+    @return: The data of each spectrum
+    @rtype: C{list} of C{list} of C{float}
+    """
+    return [[rnd.uniform(0, 10) for i in xrange(length)] for spectrum in xrange(count)]
+
+def naive_dtw(a, b, band):
+    """
+    Calculate the dynamic time warping distance over the full cost matrix,
+    with cells more than band away from the diagonal left out.
+    
+    @param a: Integrated data of one spectrum
+    @type  a: C{list} of C{float}
+    @param b: Integrated data of the other spectrum
+    @type  b: C{list} of C{float}
+    @param band: Maximum number of bins to shift by
+    @type  band: C{int}
+    @return: The distance
+    @rtype: C{float}
+    """
+    length = min(len(a), len(b))
+    infinity = float("inf")
+    cost = [[infinity] * length for i in xrange(length)]
+    for i in xrange(length):
+        for j in xrange(length):
+            if abs(i - j) > band:
+                continue
+            if i == 0 and j == 0:
+                best = 0.0
+            else:
+                best = infinity
+                if i > 0 and j > 0:
+                    best = min(best, cost[i - 1][j - 1])
+                if i > 0:
+                    best = min(best, cost[i - 1][j])
+                if j > 0:
+                    best = min(best, cost[i][j - 1])
+            cost[i][j] = abs(a[i] - b[j]) + best
+    return cost[-1][-1]
+
+def naive_linkage(distances):
+    """
+    Cluster rows of a distance matrix by average linkage, comparing every
+    pair of clusters by the mean distance between their rows at each merge.
+    
+    @param distances: Symmetric matrix of errors between rows
+    @type  distances: C{list} of C{list} of C{float}
+    @return: The two clusters merged, the error between them, and the size
+    of the new cluster, for each merge in order
+    @rtype: C{list} of C{tuple}
+    """
+    clusters = dict([(i, [i]) for i in xrange(len(distances))])
+    merges = []
+    while len(clusters) > 1:
+        labels = sorted(clusters)
+        best = None
+        for index, a in enumerate(labels):
+            for b in labels[index + 1:]:
+                error = (sum([distances[i][j] for i in clusters[a] for j in clusters[b]]) /
+                         (len(clusters[a]) * len(clusters[b])))
+                if best is None or error < best[0]:
+                    best = (error, a, b)
+        error, a, b = best
+        merged = clusters.pop(a) + clusters.pop(b)
+        clusters[len(distances) + len(merges)] = merged
+        merges.append((a, b, error, len(merged)))
+    return merges
+
+class TopKTest(unittest.TestCase):
+    """Check that pruned ranking finds the same rows as full scoring."""
+    
+    def setUp(self):
+        rnd = random.Random(1)
+        self.query = make_spectra(rnd, 1, 64)[0]
+        self.matrix = make_spectra(rnd, 60, 64)
+    
+    def full(self, name, k):
+        """
+        Rank every row by its full score.
+        
+        @param name: Name of the metric
+        @type  name: C{str}
+        @param k: Number of rows to keep
+        @type  k: C{int}
+        @return: Error and index of the best rows, lowest error first
+        @rtype: C{list} of C{tuple}
+        """
+        errors = metrics.score(name, self.query, self.matrix)
+        return sorted([(error, index) for index, error in enumerate(errors)])[:k]
+    
+    def assertSameRanking(self, expected, actual):
+        """Check that two rankings have the same rows and errors."""
+        self.assertEqual([index for error, index in expected],
+                         [index for error, index in actual])
+        for expected_row, actual_row in zip(expected, actual):
+            self.assertAlmostEqual(expected_row[0], actual_row[0], 9)
+    
+    def test_top_k(self):
+        for name in sorted(metrics.METRICS):
+            for k in (1, 5, 60, 100):
+                self.assertSameRanking(self.full(name, k),
+                                       metrics.top_k(name, self.query, self.matrix, k))
+    
+    def test_top_k_nothing(self):
+        for name in sorted(metrics.METRICS):
+            self.assertEqual(metrics.top_k(name, self.query, self.matrix, 0), [])
+    
+    def test_cascade(self):
+        levels = [(metrics.downsample(self.query, bins),
+                   [metrics.downsample(row, bins) for row in self.matrix])
+                  for bins in (4, 16)]
+        for name in ("bove", "leastsquares", "euclidean"):
+            for k in (1, 5, 20):
+                self.assertSameRanking(self.full(name, k),
+                                       metrics.cascade(name, self.query, self.matrix, k, levels))
+
+class DtwTest(unittest.TestCase):
+    """Check the banded dynamic time warping distance."""
+    
+    def setUp(self):
+        rnd = random.Random(2)
+        self.a, self.b = make_spectra(rnd, 2, 40)
+    
+    def test_matches_full_cost_matrix(self):
+        for band in (0, 1, 3, 6):
+            self.assertAlmostEqual(metrics._dtw(self.a, self.b, band),
+                                   naive_dtw(self.a, self.b, band), 9)
+    
+    def test_wide_band_is_unbanded(self):
+        self.assertAlmostEqual(metrics._dtw(self.a, self.b, len(self.a)),
+                               naive_dtw(self.a, self.b, len(self.a)), 9)
+    
+    def test_shift_within_band(self):
+        shifted = self.a[2:] + self.a[-1:] * 2
+        self.assertTrue(metrics._dtw(self.a, shifted, 3) <
+                        metrics._dtw(self.a, shifted, 0))
+    
+    def test_threshold(self):
+        distance = metrics._dtw(self.a, self.b, 3)
+        self.assertAlmostEqual(metrics._dtw(self.a, self.b, 3, distance + 1), distance, 9)
+        self.assertEqual(metrics._dtw(self.a, self.b, 3, distance / 2), float("inf"))
+
+class NnlsTest(unittest.TestCase):
+    """Check the non-negative least squares mixture weights."""
+    
+    def setUp(self):
+        self.columns = make_spectra(random.Random(3), 5, 50)
+    
+    def test_known_mixture(self):
+        target = [0.3 * a + 0.7 * b for a, b in zip(self.columns[0], self.columns[2])]
+        weights, residual = metrics.nnls(self.columns, target)
+        for expected, actual in zip([0.3, 0.0, 0.7, 0.0, 0.0], weights):
+            self.assertAlmostEqual(expected, actual, 6)
+        self.assertAlmostEqual(residual, 0.0, 6)
+    
+    def assertOptimal(self, columns, target):
+        """
+        Check that the weights found satisfy the Karush-Kuhn-Tucker
+        conditions and that the residual returned is theirs.
+        """
+        weights, residual = metrics.nnls(columns, target)
+        mixture = [sum([weight * column[i] for weight, column in zip(weights, columns)])
+                   for i in xrange(len(target))]
+        remainder = [value - mixed for value, mixed in zip(target, mixture)]
+        self.assertAlmostEqual(residual, sum([value * value for value in remainder]) ** 0.5, 6)
+        for weight, column in zip(weights, columns):
+            self.assertTrue(weight >= 0)
+            gradient = sum([value * part for value, part in zip(column, remainder)])
+            if weight > 0:
+                self.assertAlmostEqual(gradient, 0.0, 4)
+            else:
+                self.assertTrue(gradient <= 1e-4)
+    
+    def test_optimality(self):
+        # Only reachable with a negative weight, so the best non-negative
+        # weights must satisfy the Karush-Kuhn-Tucker conditions instead.
+        target = [a - 0.5 * b for a, b in zip(self.columns[0], self.columns[1])]
+        self.assertOptimal(self.columns, target)
+    
+    def test_many_columns(self):
+        # More columns than bins, so columns get dropped again on the way.
+        rnd = random.Random(6)
+        columns = make_spectra(rnd, 40, 25)
+        self.assertOptimal(columns, [rnd.uniform(0, 10) for i in xrange(25)])
+        self.assertOptimal(columns + columns[:5], [rnd.uniform(0, 10) for i in xrange(25)])
+
+class LinkageTest(unittest.TestCase):
+    """Check average-linkage clustering against merging by brute force."""
+    
+    def test_matches_naive(self):
+        rnd = random.Random(4)
+        for count in (1, 2, 3, 12):
+            distances = metrics.pairwise("euclidean", make_spectra(rnd, count, 20))
+            expected = naive_linkage(distances)
+            actual = metrics.linkage(distances)
+            self.assertEqual(len(expected), len(actual))
+            for (a, b, error, size), (c, d, actual_error, actual_size) in zip(expected, actual):
+                self.assertEqual(set([a, b]), set([c, d]))
+                self.assertAlmostEqual(error, actual_error, 9)
+                self.assertEqual(size, actual_size)
+
+if __name__ == '__main__':
+    unittest.main()
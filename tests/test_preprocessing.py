@@ -0,0 +1,77 @@
+"""
+Test the preprocessing stages and the solver behind the baseline.
+
+@organization: The Cooper Union for the Advancement of the Science and the Arts
+@license: http://opensource.org/licenses/lgpl-3.0.html GNU Lesser General Public License v3.0
+@copyright: Copyright (c) 2010, Cooper Union (Some Right Reserved)
+"""
+
+import math
+import random
+import unittest
+
+import preprocessing
+
+def make_spectrum(length):
+    """
+    Make integrated data with a few peaks on a flat background.
+    
+    @param length: Number of bins
+    @type  length: C{int}
+    @return: The data
+    @rtype: C{list} of C{float}
+    """
+    return [sum([height * math.exp(-((i - centre) / width) ** 2)
+                 for centre, width, height in ((30, 4.0, 10.0), (70, 8.0, 4.0), (120, 3.0, 7.0))])
+            for i in xrange(length)]
+
+class PentadiagonalTest(unittest.TestCase):
+    """Check the pentadiagonal solver by the residual of its solutions."""
+    
+    def test_residual(self):
+        rnd = random.Random(5)
+        for length in (1, 2, 3, 4, 10, 200):
+            first = [rnd.uniform(-1, 1) for i in xrange(length - 1)]
+            second = [rnd.uniform(-1, 1) for i in xrange(length - 2)]
+            # Diagonally dominant, so positive definite.
+            diagonal = [5 + rnd.uniform(0, 1) for i in xrange(length)]
+            vector = [rnd.uniform(-10, 10) for i in xrange(length)]
+            solution = preprocessing._solve_pentadiagonal(diagonal, first, second, vector)
+            for i in xrange(length):
+                total = diagonal[i] * solution[i]
+                for offset, band in ((1, first), (2, second)):
+                    if i >= offset:
+                        total += band[i - offset] * solution[i - offset]
+                    if i + offset < length:
+                        total += band[i] * solution[i + offset]
+                self.assertAlmostEqual(total, vector[i], 9)
+
+class StageTest(unittest.TestCase):
+    """Check what each preprocessing stage does to known data."""
+    
+    def test_baseline_ignores_linear_background(self):
+        data = make_spectrum(160)
+        tilted = [value + 3.0 + 0.05 * i for i, value in enumerate(data)]
+        for plain, corrected in zip(preprocessing.baseline(data),
+                                    preprocessing.baseline(tilted)):
+            self.assertAlmostEqual(plain, corrected, 6)
+    
+    def test_baseline_keeps_peaks(self):
+        data = [value + 3.0 for value in make_spectrum(160)]
+        corrected = preprocessing.baseline(data)
+        self.assertTrue(abs(corrected[0]) < 0.5)
+        self.assertTrue(corrected[30] > 9.0)
+    
+    def test_derivative_of_line(self):
+        data = [2.0 * i + 1.0 for i in xrange(20)]
+        half = preprocessing.SAVITZKY_GOLAY_HALF_WIDTH
+        for value in preprocessing.derivative(data)[half:-half]:
+            self.assertAlmostEqual(value, 2.0, 9)
+    
+    def test_normalized(self):
+        normalized = preprocessing.normalized(make_spectrum(160))
+        self.assertAlmostEqual(sum([value * value for value in normalized]), 1.0, 9)
+        self.assertEqual(preprocessing.normalized([0.0, 0.0]), [0.0, 0.0])
+
+if __name__ == '__main__':
+    unittest.main()